@@ -7,20 +7,45 @@ Copyright'''
 
 from ij import IJ, ImagePlus
 from ij import WindowManager as wm
-from ij.plugin.frame import RoiManager
-from ij.plugin.filter import ParticleAnalyzer
-from ij.measure import Measurements
-from ij.measure import ResultsTable
+from ij.plugin import ChannelSplitter
+from ij.plugin import ZProjector
+from ij.plugin.filter import GaussianBlur
+from ij.measure import Calibration
 from ij.process import LUT
+from ij.process import FloatProcessor
+
+from inra.ijpb.binary import BinaryImages
+from inra.ijpb.label import LabelImages
+from inra.ijpb.measure import IntensityMeasures
+from inra.ijpb.measure.region2d import Centroid
 
 from math import sqrt
+from math import hypot
+from math import pi
+from math import sin
+from math import cos
+from math import atan2
+from math import ceil
+from collections import OrderedDict
+from java.lang import System
+from org.apache.commons.math3.linear import Array2DRowRealMatrix
+from org.apache.commons.math3.stat.regression import SimpleRegression
 from jarray import zeros
+from jarray import array
+
+from statistics_toolbox import ColumnStatistics
+from OMERO_toolbox import get_image_plus
+from OMERO_toolbox import iter_images
+from OMERO_toolbox import TableWriter
 
 HOMOGENEITY_RADIUS = 1
 HOMOGENEITY_THRESHOLD = 'Otsu'
 HOMOGENEITY_ACCEPTANCE_THRESHOLD = 70
+HOMOGENEITY_SPOT_DISTANCE = 20 # Distance between the spots of the slide, calibrated
 REMOVE_CROSS = True # Remove cross from the homogeneity image
 
+_HOMOGENEITY_LUTS = {}
+
 # seuil_calibration=newArray("Li",100,255);
 # seuil_homogeneite=newArray("Otsu",100,255);
 # seuil_coalignement_tot=newArray("Default",100,255);
@@ -42,171 +67,550 @@ REMOVE_CROSS = True # Remove cross from the homogeneity image
 #
 
 def compute_mean(values):
-    return sum(values)/len(values)
+    return ColumnStatistics(values).mean()
 
 
 def compute_median(values):
-    values = sorted(values)
-    index = (len(values) - 1) // 2
-    if (len(values) % 2):
-        return values[index]
-    else:
-        return (values[index] + values[index + 1])/2.0
+    return ColumnStatistics(values).median()
 
 
 def compute_std_dev(values, mean=None):
-    if not mean:
-        mean = compute_mean(values)
-    s = 0
-    for value in values:
-        s += pow(value - mean, 2)
-    return sqrt(s / float(len(values) -1))
+    return ColumnStatistics(values).std_dev(mean)
+
+
+class Spots(object):
+    """Spots detected in an image, stored as one array per measurement.
+
+    The spot at index i is drawn with the value ids[i] in the labels image.
+    Areas are calibrated, positions are centroids in pixels.
+    """
+
+    MEASUREMENTS = ('area', 'integrated_density', 'max', 'x', 'y')
+
+    def __init__(self, labels, columns, ids):
+        self.labels = labels
+        self.ids = ids
+        for name in self.MEASUREMENTS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def select(self, indexes):
+        """Returns the spots at the given indexes"""
+        columns = dict((name, array([getattr(self, name)[i] for i in indexes], 'd'))
+                       for name in self.MEASUREMENTS)
+        return Spots(self.labels, columns, array([self.ids[i] for i in indexes], 'i'))
+
+    def split_by_area(self, min_area=0, max_area=float('inf')):
+        """Returns the spots with an area inside the range and the spots outside it"""
+        inside = []
+        outside = []
+        for i, area in enumerate(self.area):
+            if min_area <= area <= max_area:
+                inside.append(i)
+            else:
+                outside.append(i)
+        return self.select(inside), self.select(outside)
+
+
+def _column(table, heading):
+    return table.getColumnAsDoubles(table.getColumnIndex(heading))
+
+
+def detect_spots(imp, threshold_method, min_size=0, max_size=float('inf'), exclude_edges=True):
+    """Thresholds an image and measures its connected components.
+
+    The thresholded mask is labelled by MorphoLibJ and the components are
+    measured from the label image by a few whole-image passes in Java
+    (border removal, pixel counts, intensities and centroids), without
+    tracing a Roi per spot. Labels are 32-bit, so the number of spots is not
+    limited to 65535.
+    :param imp: a 2D ImagePlus
+    :param threshold_method: the name of an ImageJ auto-threshold method
+    :param min_size: the minimum area of a spot, in pixels
+    :param max_size: the maximum area of a spot, in pixels
+    :param exclude_edges: if True the spots touching the edges are discarded
+    :return: a Spots
+    """
+    IJ.setAutoThreshold(imp, threshold_method + " dark")
+    mask = imp.createThresholdMask()
+    imp.getProcessor().resetThreshold()
+
+    labels = BinaryImages.componentsLabeling(mask, 4, 32)
+    if exclude_edges:
+        LabelImages.removeBorderLabels(labels)
+    label_ids = LabelImages.findAllLabels(labels)
+    counts = LabelImages.pixelCount(labels, label_ids)
+    keep = [i for i, count in enumerate(counts) if min_size <= count <= max_size]
+
+    calibration = imp.getCalibration()
+    pixel_area = calibration.pixelWidth * calibration.pixelHeight
+    intensities = IntensityMeasures(imp, ImagePlus('labels', labels))
+    means = _column(intensities.getMean(), 'Mean')
+    maxima = _column(intensities.getMax(), 'Max')
+    # Centroids in pixels
+    centroids = Centroid.centroids(labels, label_ids, Calibration())
+
+    columns = {'area': array([counts[i] * pixel_area for i in keep], 'd'),
+               'integrated_density': array([means[i] * counts[i] * pixel_area for i in keep], 'd'),
+               'max': array([maxima[i] for i in keep], 'd'),
+               'x': array([centroids[i].getX() for i in keep], 'd'),
+               'y': array([centroids[i].getY() for i in keep], 'd')}
+
+    return Spots(labels, columns, array([label_ids[i] for i in keep], 'i'))
+
+
+def _to_byte(value):
+    # LUT entries are signed java bytes
+    return value - 256 if value > 127 else value
+
+
+def get_homogeneity_lut(acceptance_threshold):
+    """Returns a LUT for homogeneity maps in percent, built once per acceptance threshold.
+
+    Values below the acceptance threshold are shown in red and the others in
+    a green ramp.
+    """
+    if acceptance_threshold not in _HOMOGENEITY_LUTS:
+        red = zeros(256, 'b')
+        green = zeros(256, 'b')
+        blue = zeros(256, 'b')
+        limit = acceptance_threshold * 255 / 100.0
+        for i in range(256):
+            if i < limit:
+                red[i] = _to_byte(255)
+            else:
+                green[i] = _to_byte(i)
+        _HOMOGENEITY_LUTS[acceptance_threshold] = LUT(red, green, blue)
+
+    return _HOMOGENEITY_LUTS[acceptance_threshold]
+
+
+def get_spot_distance(imp, spot_count):
+    """Returns the distance between the spots of the slide in pixels"""
+    calibration = imp.getCalibration()
+    if calibration.scaled():
+        return HOMOGENEITY_SPOT_DISTANCE / calibration.pixelWidth
+    # TODO: This is a rough estimation that does not take into account margins or rectangular FOVs
+    return imp.getWidth() / max(int(sqrt(spot_count)), 1)
+
+
+def _grid_phase(positions, spot_distance):
+    """Returns the position, in [0, spot_distance), of the grid the spots lie on.
+
+    It is the circular mean of the positions modulo the spot distance, so
+    that spots on either side of a multiple of the distance agree.
+    """
+    sines = 0.0
+    cosines = 0.0
+    for position in positions:
+        angle = 2 * pi * (position % spot_distance) / spot_distance
+        sines += sin(angle)
+        cosines += cos(angle)
+    return (atan2(sines, cosines) / (2 * pi) * spot_distance) % spot_distance
+
+
+def _interpolation_weights(size, start, spot_distance, cells):
+    """Returns the size x cells matrix interpolating linearly, along one axis,
+    between the centres of the lattice cells. Pixels beyond the outer centres
+    take the value of the outer cells.
+    """
+    weights = Array2DRowRealMatrix(size, cells)
+    for position in range(size):
+        cell = (position + 0.5 - start) / spot_distance - 0.5
+        cell = min(max(cell, 0.0), cells - 1.0)
+        lower = min(int(cell), max(cells - 2, 0))
+        fraction = cell - lower
+        weights.setEntry(position, lower, 1.0 - fraction)
+        if fraction > 0:
+            weights.setEntry(position, lower + 1, fraction)
+    return weights
+
+
+def homogeneity_map(spots, width, height, spot_distance):
+    """Interpolates the maxima of the spots over the image.
+
+    The spots are binned on the lattice of the slide, keeping the brightest
+    spot of every cell. The cells are centred on the grid of the detected
+    spots, whatever its offset in the image, and the map is interpolated
+    bilinearly between the cell centres. The interpolation is applied as two
+    weight matrices, one per axis, so no pixel is processed from Jython.
+    Empty cells take the mean of their filled neighbours.
+    :return: a FloatProcessor with the map in percent of the brightest spot
+        and the list of lattice values in percent
+    """
+    start_x = _grid_phase(spots.x, spot_distance) - spot_distance / 2.0
+    start_y = _grid_phase(spots.y, spot_distance) - spot_distance / 2.0
+    columns = max(int(ceil((width - start_x) / spot_distance)), 1)
+    rows = max(int(ceil((height - start_y) / spot_distance)), 1)
+    lattice = [None] * (columns * rows)
+    for x, y, value in zip(spots.x, spots.y, spots.max):
+        column = min(max(int((x - start_x) // spot_distance), 0), columns - 1)
+        row = min(max(int((y - start_y) // spot_distance), 0), rows - 1)
+        index = row * columns + column
+        if lattice[index] is None or value > lattice[index]:
+            lattice[index] = value
+
+    filled = [value for value in lattice if value is not None]
+    if not filled:
+        raise Exception('No spots to build a homogeneity map')
+    peak = max(filled)
+    default = ColumnStatistics(filled).median()
+    values = []
+    for index, value in enumerate(lattice):
+        if value is None:
+            row, column = divmod(index, columns)
+            neighbours = [lattice[r * columns + c]
+                          for r, c in ((row - 1, column), (row + 1, column),
+                                       (row, column - 1), (row, column + 1))
+                          if 0 <= r < rows and 0 <= c < columns and
+                          lattice[r * columns + c] is not None]
+            value = sum(neighbours) / len(neighbours) if neighbours else default
+        values.append(100.0 * value / peak)
+
+    lattice_matrix = Array2DRowRealMatrix(rows, columns)
+    for index, value in enumerate(values):
+        lattice_matrix.setEntry(index // columns, index % columns, value)
+    map_matrix = _interpolation_weights(height, start_y, spot_distance, rows) \
+        .multiply(lattice_matrix) \
+        .multiply(_interpolation_weights(width, start_x, spot_distance, columns).transpose())
+    pixels = zeros(width * height, 'd')
+    for y, row_values in enumerate(map_matrix.getData()):
+        System.arraycopy(row_values, 0, pixels, y * width, width)
+    map_ip = FloatProcessor(width, height, pixels)
+    map_ip.setMinAndMax(0, 100)
+
+    return map_ip, values
+
+
+def _measure_homogeneity(imp, spots):
+    """Measures the spots of a homogeneity slide and builds its homogeneity map.
+
+    :param imp: the 2D, blurred image the spots were detected on
+    :param spots: the Spots of the image
+    :return: the map as an ImagePlus and a dictionary of measurements
+    """
+    areas = ColumnStatistics(spots.area)
+
+    median_areas = areas.median()
+    st_dev_areas = areas.std_dev(median_areas)
+    thresholds_areas = (median_areas - (2 * st_dev_areas), median_areas + (2 * st_dev_areas))
+
+    if REMOVE_CROSS:
+        spots = spots.split_by_area(max_area=thresholds_areas[1])[0]
+
+    roi_measurements = {'integrated_density': spots.integrated_density,
+                        'max': spots.max,
+                        'area': spots.area}
+
+    measuremnts = {}
+    for name, values in roi_measurements.items():
+        statistics = ColumnStatistics(values)
+        measuremnts['mean_' + name] = statistics.mean()
+        measuremnts['median_' + name] = statistics.median()
+        measuremnts['std_dev_' + name] = statistics.std_dev()
+
+    # Generate the homogeneity image from the spot lattice
+    map_ip, lattice = homogeneity_map(spots, imp.getWidth(), imp.getHeight(),
+                                      get_spot_distance(imp, len(spots)))
+    measuremnts['std_dev_homogeneity'] = ColumnStatistics(lattice).std_dev()
+    map_imp = ImagePlus('Homogeneity map', map_ip)
+    map_imp.setLut(get_homogeneity_lut(HOMOGENEITY_ACCEPTANCE_THRESHOLD))
+
+    return map_imp, measuremnts
 
 
 def analyze_homogeneity(image_title):
     IJ.selectWindow(image_title)
     raw_imp = IJ.getImage()
-    IJ.run(raw_imp, "Duplicate...", "title=Homogeneity duplicate")
-    IJ.selectWindow('Homogeneity')
-    hg_imp = IJ.getImage()
+    hg_imp = raw_imp.duplicate()
+    hg_imp.setTitle('Homogeneity')
 
     # Get a 2D image
     if hg_imp.getNSlices() > 1:
-        IJ.run(hg_imp, "Z Project...", "projection=[Average Intensity]")
-        hg_imp.close()
-        IJ.selectWindow('MAX_Homogeneity')
-        hg_imp = IJ.getImage()
+        hg_imp = ZProjector.run(hg_imp, 'avg')
         hg_imp.setTitle('Homogeneity')
 
     # Blur and BG correct the image
     IJ.run(hg_imp, 'Gaussian Blur...', 'sigma=' + str(HOMOGENEITY_RADIUS) + ' stack')
 
     # Detect the spots
-    IJ.setAutoThreshold(hg_imp, HOMOGENEITY_THRESHOLD + " dark")
-    rm = RoiManager(True)
-    table = ResultsTable()
-    pa = ParticleAnalyzer(ParticleAnalyzer.ADD_TO_MANAGER,
-                          ParticleAnalyzer.EXCLUDE_EDGE_PARTICLES,
-                          Measurements.AREA, # measurements
-                          table, # Output table
-                          0, # MinSize
-                          500, # MaxSize
-                          0.0, # minCirc
-                          1.0) # maxCirc
-    pa.setHideOutputImage(True)
-    pa.analyze(hg_imp)
-
-    areas = table.getColumn(table.getHeadings().index('Area'))
-
-    median_areas = compute_median(areas)
-    st_dev_areas = compute_std_dev(areas, median_areas)
-    thresholds_areas = (median_areas - (2 * st_dev_areas), median_areas + (2 * st_dev_areas))
-
-    roi_measurements = {'integrated_density': [],
-                        'max': [],
-                        'area': []}
-    IJ.setForegroundColor(0, 0, 0)
-    for roi in rm.getRoisAsArray():
-        hg_imp.setRoi(roi)
-        if REMOVE_CROSS and hg_imp.getStatistics().AREA > thresholds_areas[1]:
-            rm.runCommand('Fill')
-        else:
-            roi_measurements['integrated_density'].append(hg_imp.getStatistics().INTEGRATED_DENSITY)
-            roi_measurements['max'].append(hg_imp.getStatistics().MIN_MAX)
-            roi_measurements['integrated_densities'].append(hg_imp.getStatistics().AREA)
-
-        rm.runCommand('Delete')
-
-    measuremnts = {'mean_integrated_density': compute_mean(roi_measurements['integrated_density']),
-                   'median_integrated_density': compute_median(roi_measurements['integrated_density']),
-                   'std_dev_integrated_density': compute_std_dev(roi_measurements['integrated_density']),
-                   'mean_max': compute_mean(roi_measurements['max']),
-                   'median_max': compute_median(roi_measurements['max']),
-                   'std_dev_max': compute_std_dev(roi_measurements['max']),
-                   'mean_area': compute_mean(roi_measurements['max']),
-                   'median_area': compute_median(roi_measurements['max']),
-                   'std_dev_area': compute_std_dev(roi_measurements['max']),
-                   }
-
-    # generate homogeinity image
-    # calculate interpoint distance in pixels
-    nr_point_columns = int(sqrt(len(measuremnts['mean_max'])))
-    # TODO: This is a rough estimation that does not take into account margins or rectangular FOVs
-    inter_point_dist = hg_imp.getWidth() / nr_point_columns
-    IJ.run(hg_imp, "Maximum...", "radius="+(inter_point_dist*1.22))
-    # Normalize to 100
-    IJ.run(hg_imp, "Divide...", "value=" + max(roi_measurements['max'] / 100))
-    IJ.run(hg_imp, "Gaussian Blur...", "sigma=" + (inter_point_dist/2))
-    hg_imp.getProcessor.setMinAndMax(0, 255)
-
-    # Create a LUT based on a predefined threshold
-    red = zeros(256, 'b')
-    green = zeros(256, 'b')
-    blue = zeros(256, 'b')
-    acceptance_threshold = HOMOGENEITY_ACCEPTANCE_THRESHOLD * 256 / 100
-    for i in range(256):
-        red[i] = (i - acceptance_threshold)
-        green[i] = (i)
-    homogeneity_LUT = LUT(red, green, blue)
-    hg_imp.setLut(homogeneity_LUT)
-
-    return hg_imp, measuremnts
-
-
-
-origid=getImageID();
-Stack.getDimensions(width, height, channels, slices, frames);
-getPixelSize(unit, pixelWidth, pixelHeight);
-inter_point=20/pixelWidth; //Distance entre points
-
-run("Maximum...", "radius="+(inter_point*1.22)); // taille du filtre diagonale entre points
-run("Duplicate...", "title=temp duplicate");
-run("32-bit");
-getStatistics(area, mean, min, max, std, histogram);
-run("Divide...", "value="+max/100); //Normalisation en pourcentage
-getStatistics(area, mean, min, max, std, histogram);
-std_homo=std;
-close();
-selectWindow("homogeneite");
-run("Gaussian Blur...", "sigma="+(inter_point/2));// taille du filtre diagonale sur 2
-                                                                                    // 10 classes de valeurs
-run("32-bit");
-getStatistics(area, mean, min, max, std, histogram);
-run("Divide...", "value="+max); //--> valeurs de 0 a 1
-run("Multiply...", "value=10"); //--> valeurs de 0 a 10
-run("Conversions...", " ");
-run("8-bit");
-getStatistics(area, mean, min, max, std, histogram);
-print("Deviation standard normalisee de l homogeneite: "+std_homo); // calcul sur des valeurs de 1 a 10
-
-run("Multiply...", "value=25.5");
-run("Conversions...", "scale");
-run("Size...", "width=800 height=800 constrain average interpolation=Bilinear");
-//print(dir_argoloj+"homogeneite.jpg");
-saveAs("Jpeg", dir_argoloj+"homogeneite.jpg");
-
-}
-
-
-macro 'Homogeneite Action Tool Options'  {
-    Dialog.create("Homogeneite");
-Dialog.addNumber("Taille du filtre:", radius_homogeneite);
-Dialog.addChoice("Seuillage:", newArray("Manuel","Default","Huang","Intermodes","IsoData","IJ_IsoData","Li","MaxEntropy","Mean","MinError","Minimum","Moments","Otsu","Percentile","RenyiEntropy","Shanbhag","Triangle","Yen"),seuil_homogeneite[0]);
-Dialog.addSlider("Surface de la croix mini", 1, 500, taille_homogeneite[0]);
-Dialog.addSlider("Surface de la croix maxi", taille_homogeneite[0], 500, taille_homogeneite[1]);
-Dialog.addCheckbox("Croix centrale a enlever", croix);
-Dialog.addCheckbox("Valeurs par defaut", false);
-Dialog.show();
-radius_homogeneite=Dialog.getNumber();
-seuil_homogeneite[0]=Dialog.getChoice();
-taille_homogeneite[0]=Dialog.getNumber();
-taille_homogeneite[1]=Dialog.getNumber();
-croix=Dialog.getCheckbox();
-raz_value=Dialog.getCheckbox();
-if(raz_value){
-    seuil_homogeneite=newArray("Otsu",100,255);
-radius_homogeneite=1;
-taille_homogeneite=newArray(20,100);
-croix=false;
-}
-}
+    spots = detect_spots(hg_imp, HOMOGENEITY_THRESHOLD, 0, 500)
+
+    return _measure_homogeneity(hg_imp, spots)
+
+
+# QC batch engine
+
+# The auto-threshold method, the gaussian blur radius and the range of spot
+# sizes, in pixels, of every analysis. Analyses with the same threshold and
+# radius share their detection
+QC_PARAMETERS = {'calibration': {'threshold': 'Li', 'radius': 1, 'size': (50, 500)},
+                 'homogeneity': {'threshold': HOMOGENEITY_THRESHOLD,
+                                 'radius': HOMOGENEITY_RADIUS,
+                                 'size': (0, 500)},
+                 'coalignment': {'threshold': 'Yen', 'radius': 2, 'size': (2, 10000)},
+                 'dispersion': {'threshold': 'Minimum', 'radius': 3, 'size': (2, 10000)},
+                 # The spot size is the measurement: it is taken on the unblurred plane
+                 'resolution': {'threshold': 'Default', 'radius': 0, 'size': (2, 10000)},
+                 'geometry': {'threshold': 'Default', 'radius': 0, 'size': (2, 10000)},
+                 # The optical densities of the patches of the linearity slide, from
+                 # left to right. They depend on the slide, so they have to be set
+                 'linearity': {'threshold': 'Default', 'radius': 2, 'size': (200, 1000000),
+                               'attenuations': None},
+                 }
+
+QC_TABLE_PARAMETERS = [('image_id', 'Long', 'The id of the image'),
+                       ('image_name', 'String', 'The name of the image'),
+                       ('analysis', 'String', 'The QC analysis'),
+                       ('channel', 'Long', 'The channel index'),
+                       ('measurement', 'String', 'The name of the measurement'),
+                       ('value', 'Double', 'The value of the measurement')]
+
+
+class QCImage(object):
+    """An image under QC. Holds the planes and the spots shared between analyses.
+
+    Every channel is projected once, blurred once per radius and detected
+    once per threshold and radius, whatever the number of analyses using them.
+    :param imp: an ImagePlus
+    """
+
+    def __init__(self, imp):
+        self.imp = imp
+        self._projections = None
+        self._planes = {}
+        self._spots = {}
+
+    def channel_count(self):
+        return self.imp.getNChannels()
+
+    def _projection(self, channel):
+        if self._projections is None:
+            self._projections = []
+            for channel_imp in ChannelSplitter.split(self.imp):
+                if channel_imp.getStackSize() > 1:
+                    channel_imp = ZProjector.run(channel_imp, 'avg')
+                self._projections.append(channel_imp)
+        return self._projections[channel]
+
+    def plane(self, channel, radius):
+        """Returns the projection of a channel blurred with a gaussian of the given radius"""
+        key = (channel, radius)
+        if key not in self._planes:
+            plane = self._projection(channel).duplicate()
+            plane.setProcessor(plane.getProcessor().convertToFloat())
+            if radius:
+                GaussianBlur().blurGaussian(plane.getProcessor(), radius)
+            self._planes[key] = plane
+        return self._planes[key]
+
+    def spots(self, channel, parameters):
+        """Returns the spots of a channel detected with the parameters of an analysis.
+
+        The detection is shared by the analyses with the same threshold and
+        radius. The size range of each analysis is applied afterwards.
+        """
+        key = (channel, parameters['threshold'], parameters['radius'])
+        if key not in self._spots:
+            self._spots[key] = detect_spots(self.plane(channel, parameters['radius']),
+                                            parameters['threshold'])
+        calibration = self.imp.getCalibration()
+        pixel_area = calibration.pixelWidth * calibration.pixelHeight
+        min_size, max_size = parameters['size']
+        return self._spots[key].split_by_area(min_size * pixel_area, max_size * pixel_area)[0]
+
+    def close(self):
+        for imp in self._planes.values():
+            imp.close()
+        self._planes = {}
+        self._spots = {}
+        self._projections = None
+
+
+def _nearest(reference, spots, cell_size, same=False):
+    """Returns, for every spot, the index of the closest reference spot and its distance.
+
+    The reference spots are binned in cells of cell_size pixels and only the
+    neighbouring cells are searched, so spots farther than cell_size may not
+    be found and get (None, None).
+    :param same: True if spots and reference are the same, so that a spot is
+        not matched with itself
+    """
+    grid = {}
+    for i, (x, y) in enumerate(zip(reference.x, reference.y)):
+        grid.setdefault((int(x // cell_size), int(y // cell_size)), []).append(i)
+
+    matches = []
+    for index, (x, y) in enumerate(zip(spots.x, spots.y)):
+        best = (None, None)
+        cell_x = int(x // cell_size)
+        cell_y = int(y // cell_size)
+        for grid_x in (cell_x - 1, cell_x, cell_x + 1):
+            for grid_y in (cell_y - 1, cell_y, cell_y + 1):
+                for i in grid.get((grid_x, grid_y), ()):
+                    if same and i == index:
+                        continue
+                    distance = hypot(reference.x[i] - x, reference.y[i] - y)
+                    if best[1] is None or distance < best[1]:
+                        best = (i, distance)
+        matches.append(best)
+
+    return matches
+
+
+def _neighbour_distances(qc_image, spots):
+    cell_size = 1.5 * get_spot_distance(qc_image.imp, len(spots))
+    return [d for i, d in _nearest(spots, spots, cell_size, same=True) if d is not None]
+
+
+def qc_calibration(qc_image, parameters):
+    """Measures the pixel size from the known distance between the spots"""
+    distance = ColumnStatistics(_neighbour_distances(qc_image, qc_image.spots(0, parameters)))
+    return [(0, 'spot_distance_pixels', distance.median()),
+            (0, 'measured_pixel_size', HOMOGENEITY_SPOT_DISTANCE / distance.median()),
+            (0, 'pixel_size', qc_image.imp.getCalibration().pixelWidth)]
+
+
+def qc_homogeneity(qc_image, parameters):
+    rows = []
+    for channel in range(qc_image.channel_count()):
+        measurements = _measure_homogeneity(qc_image.plane(channel, parameters['radius']),
+                                            qc_image.spots(channel, parameters))[1]
+        rows.extend((channel, name, value) for name, value in sorted(measurements.items()))
+    return rows
+
+
+def qc_coalignment(qc_image, parameters):
+    """Measures the shift of the spots of every channel relative to the first one"""
+    pixel_size = qc_image.imp.getCalibration().pixelWidth
+    reference = qc_image.spots(0, parameters)
+    cell_size = get_spot_distance(qc_image.imp, len(reference)) / 2.0
+    rows = []
+    for channel in range(1, qc_image.channel_count()):
+        spots = qc_image.spots(channel, parameters)
+        shifts_x = []
+        shifts_y = []
+        for index, (match, distance) in enumerate(_nearest(reference, spots, cell_size)):
+            if match is not None:
+                shifts_x.append(spots.x[index] - reference.x[match])
+                shifts_y.append(spots.y[index] - reference.y[match])
+        shift_x = ColumnStatistics(shifts_x).mean() * pixel_size
+        shift_y = ColumnStatistics(shifts_y).mean() * pixel_size
+        rows.extend([(channel, 'shift_x', shift_x),
+                     (channel, 'shift_y', shift_y),
+                     (channel, 'shift', hypot(shift_x, shift_y)),
+                     (channel, 'matched_spots', len(shifts_x))])
+    return rows
+
+
+def qc_dispersion(qc_image, parameters):
+    """Measures the variation of the intensity of the spots"""
+    rows = []
+    for channel in range(qc_image.channel_count()):
+        spots = qc_image.spots(channel, parameters)
+        for name, values in (('max', spots.max), ('integrated_density', spots.integrated_density)):
+            statistics = ColumnStatistics(values)
+            rows.append((channel, 'cv_' + name, statistics.std_dev() / statistics.mean()))
+    return rows
+
+
+def qc_resolution(qc_image, parameters):
+    """Measures the diameter of the spots, as the diameter of a disc of the same area"""
+    calibration = qc_image.imp.getCalibration()
+    pixel_area = calibration.pixelWidth * calibration.pixelHeight
+    rows = []
+    for channel in range(qc_image.channel_count()):
+        areas = ColumnStatistics(qc_image.spots(channel, parameters).area)
+        rows.extend([(channel, 'median_spot_diameter', 2 * sqrt(areas.median() / pi)),
+                     (channel, 'median_spot_diameter_pixels',
+                      2 * sqrt(areas.median() / pixel_area / pi))])
+    return rows
+
+
+def qc_geometry(qc_image, parameters):
+    """Measures the regularity of the spot lattice"""
+    distances = ColumnStatistics(_neighbour_distances(qc_image, qc_image.spots(0, parameters)))
+    pixel_size = qc_image.imp.getCalibration().pixelWidth
+    return [(0, 'mean_spot_distance', distances.mean() * pixel_size),
+            (0, 'cv_spot_distance', distances.std_dev() / distances.mean())]
+
+
+def qc_linearity(qc_image, parameters):
+    """Fits the mean intensity of the patches of the slide against their transmission.
+
+    The patches are matched from left to right with the optical densities in
+    parameters['attenuations'], and a linear response gives an intensity
+    proportional to 10 ** -density.
+    """
+    attenuations = parameters.get('attenuations')
+    if not attenuations:
+        raise Exception('The attenuations of the linearity patches are not set')
+    rows = []
+    for channel in range(qc_image.channel_count()):
+        spots = qc_image.spots(channel, parameters)
+        if len(spots) != len(attenuations):
+            raise Exception('Found ' + str(len(spots)) + ' patches in channel ' + str(channel) +
+                            ' but ' + str(len(attenuations)) + ' attenuations are set')
+        patches = sorted(zip(spots.x, spots.integrated_density, spots.area))
+        regression = SimpleRegression()
+        for attenuation, (x, density, area) in zip(attenuations, patches):
+            regression.addData(pow(10, -attenuation), density / area)
+        rows.extend([(channel, 'patch_count', len(patches)),
+                     (channel, 'linearity_r2', regression.getRSquare()),
+                     (channel, 'slope', regression.getSlope()),
+                     (channel, 'intercept', regression.getIntercept())])
+    return rows
+
+
+QC_ANALYSES = OrderedDict([('calibration', qc_calibration),
+                           ('homogeneity', qc_homogeneity),
+                           ('coalignment', qc_coalignment),
+                           ('dispersion', qc_dispersion),
+                           ('resolution', qc_resolution),
+                           ('geometry', qc_geometry),
+                           ('linearity', qc_linearity)])
+
+
+def run_dataset_qc(gateway, dataset_id, group_id, analyses=None, table_name='ArgoloJ QC'):
+    """Runs the QC analyses on every image of a dataset and writes one table for the dataset.
+
+    Every image is read once and the analyses sharing their detection
+    parameters share the detection. The measurements are streamed to a
+    single table, with a row per measurement, attached to the dataset.
+    :param gateway: a gateway to the omero server
+    :param dataset_id: the id of the dataset
+    :param group_id: the id of the group the dataset belongs to
+    :param analyses: the names of the analyses to run. Defaults to all of them,
+        but linearity when the attenuations of its patches are not set
+    :param table_name: the name of the table
+    :return: the file annotation of the table and a list of
+        (image_id, analysis, error) tuples for the analyses that failed
+    """
+    if analyses is None:
+        analyses = [name for name in QC_ANALYSES
+                    if name != 'linearity' or QC_PARAMETERS[name]['attenuations']]
+    writer = TableWriter(gateway, QC_TABLE_PARAMETERS, table_name, group_id)
+    failures = []
+    try:
+        for image in iter_images(gateway, dataset_id, group_id):
+            qc_image = QCImage(get_image_plus(gateway, image['id'], group_id))
+            try:
+                for analysis in analyses:
+                    try:
+                        rows = QC_ANALYSES[analysis](qc_image, QC_PARAMETERS[analysis])
+                    except Exception as e:
+                        print('Failed ' + analysis + ' on image ' + str(image['id']) + ': ' + str(e))
+                        failures.append((image['id'], analysis, str(e)))
+                        continue
+                    for channel, measurement, value in rows:
+                        writer.add_row((image['id'], image['name'], analysis, channel,
+                                        measurement, value))
+            finally:
+                qc_image.close()
+                qc_image.imp.close()
+    finally:
+        annotation = writer.close(dataset_ids=[dataset_id])
+
+    return annotation, failures
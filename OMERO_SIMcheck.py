@@ -1,302 +1,572 @@
-from operator import itemgetter
+import re
 import os
+import threading
 from java.lang.reflect import Array
 from java.lang import String
-
-
-from OMERO_toolbox import open_image_plus
-from OMERO_toolbox import omero_connect
-from OMERO_toolbox import get_image_properties
-from OMERO_toolbox import add_images_key_values
-from OMERO_toolbox import upload_image
+from java.lang import System
+from java.io import ByteArrayOutputStream
+from java.io import PrintStream
+from java.awt import GraphicsEnvironment
+
+
+from OMERO_toolbox import get_image_plus
+from OMERO_toolbox import get_omero_session
+from OMERO_toolbox import iter_images
+from OMERO_toolbox import pair_images
+from OMERO_toolbox import get_image_fingerprint
+from OMERO_toolbox import ResultCache
+from OMERO_toolbox import Prefetcher
+from OMERO_toolbox import get_image_memory_size
+from OMERO_toolbox import WriteBehindQueue
 
 from ij import IJ
-
-
-def parse_log(string):
-    info = IJ.getLog()
-    parse_output = {}
-    parsed_lines = [line for line in info.splitlines() if string in line]
-    for line in parsed_lines:
-        key, value = line.split(' = ')
-        parse_output[key] = value
-
-    return parse_output
+from ij.macro import Interpreter
+from ij.process import ImageConverter
+
+from SIMcheck import Raw_IntensityProfiles
+from SIMcheck import Raw_FourierProjections
+from SIMcheck import Raw_MotionAndIllumVar
+from SIMcheck import Raw_ModContrast
+from SIMcheck import Rec_ModContrastMap
+from SIMcheck import Rec_IntensityHistogram
+from SIMcheck import Rec_SAMismatch
+from SIMcheck import Rec_FourierPlots
+
+# Plugins running in parallel report one at a time so that the lines they
+# write to the log can be attributed to a single invocation
+_LOG_LOCK = threading.Lock()
+
+# Without a display (--headless) ImageJ writes the log to the standard output
+HEADLESS = GraphicsEnvironment.isHeadless()
+
+
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_CHANNEL = re.compile(r'^(?:C|Channel\s*)(\d+)\b\W*(.*)$')
+
+
+def parse_measurements(log, names):
+    """Parses the 'key = value' lines of a plugin report in a single pass.
+
+    Only the lines whose key contains one of names are kept. Values are
+    converted to floats when they start with a number.
+    Returns a {key: value} dictionary.
+    """
+    measurements = {}
+    for line in log.splitlines():
+        key, separator, value = line.partition(' = ')
+        if not separator or not [name for name in names if name in key]:
+            continue
+        number = _NUMBER.match(value.strip())
+        measurements[key.strip()] = float(number.group()) if number else value.strip()
+
+    return measurements
+
+
+def measurements_by_channel(measurements):
+    """Groups measurements whose key starts with a channel (C1, Channel 2...)
+    into a {channel: {name: value}} dictionary. Other measurements go under None.
+    """
+    channels = {}
+    for key, value in measurements.items():
+        match = _CHANNEL.match(key)
+        if match:
+            channels.setdefault(int(match.group(1)), {})[match.group(2)] = value
+        else:
+            channels.setdefault(None, {})[key] = value
+
+    return channels
+
+
+def run_plugin(plugin, imps, **fields):
+    """Runs a SIMcheck plugin on ImagePlus objects without selecting any window.
+
+    Public fields of the plugin (angles, phases...) are set from the keyword
+    arguments when the plugin has them.
+    Returns the output images and the text reported by this invocation only,
+    to be parsed with parse_measurements.
+    """
+    for field in fields:
+        if hasattr(plugin, field):
+            setattr(plugin, field, fields[field])
+    results = plugin.exec(imps)
+    log = _report(results)
+
+    return [results.getImp(i) for i in range(results.numImps())], log
+
+
+def _report(results):
+    """Returns the text reported by a SIMcheck ResultSet, with or without a display.
+
+    With a display the Log window is cleared once the report is read, so that
+    reading it does not get slower as the run goes on.
+    """
+    with _LOG_LOCK:
+        if HEADLESS:
+            stream = ByteArrayOutputStream()
+            stdout = System.out
+            System.setOut(PrintStream(stream, True))
+            try:
+                results.report()
+            finally:
+                System.setOut(stdout)
+            return stream.toString()
+
+        start = len(IJ.getLog() or '')
+        results.report()
+        log = (IJ.getLog() or '')[start:]
+        IJ.log('\\Clear')
+        return log
 
 
 # RAW image analysis
-def channel_intensity_profiles(image_title):
-    IJ.selectWindow(image_title)
-    IJ.run("Channel Intensity Profiles", "angles=3 phases=5")
-
-    IJ.selectWindow(image_title.rsplit('.', 1)[0] + '_CIP')
-    cip_imp = IJ.getImage()
+def channel_intensity_profiles(raw_imp):
+    output, log = run_plugin(Raw_IntensityProfiles(), [raw_imp], angles=3, phases=5)
 
-    statistics = {}
-    statistics.update(parse_log('total intensity variation (%) = '))
-    statistics.update(parse_log('estimated intensity decay (%) = '))
-    statistics.update(parse_log('maximum intensity difference between angles (%) = '))
-    statistics.update(parse_log('relative intensity fluctuations (%) = '))
+    statistics = parse_measurements(log, ['total intensity variation (%)',
+                                          'estimated intensity decay (%)',
+                                          'maximum intensity difference between angles (%)',
+                                          'relative intensity fluctuations (%)'])
 
-    return [cip_imp], statistics
+    return output, statistics
 
 
-def fourier_projections(image_title):
-    IJ.selectWindow(image_title)
-    IJ.run("Fourier Projections", "angles=3 phases=5")
+def fourier_projections(raw_imp):
+    output, log = run_plugin(Raw_FourierProjections(), [raw_imp], angles=3, phases=5)
 
-    IJ.selectWindow(image_title.rsplit('.', 1)[0] + '_FPJ')
-    fpj_imp = IJ.getImage()
+    return output
 
-    return [fpj_imp]
 
+def motion_illumination_variation(raw_imp):
+    output, log = run_plugin(Raw_MotionAndIllumVar(), [raw_imp], angles=3, phases=5)
 
-def motion_illumination_variation(image_title):
-    IJ.selectWindow(image_title)
-    IJ.run("Motion & Illumination Variation", "angles=3 phases=5")
+    return output
 
-    IJ.selectWindow(image_title.rsplit('.', 1)[0] + '_MIV')
-    miv_imp = IJ.getImage()
 
-    return [miv_imp]
-
-
-def modulation_contrast(raw_image_title, sir_image_title, do_map):
-    IJ.selectWindow(raw_image_title)
-    IJ.run("Modulation Contrast", "angles=3 phases=5 z_window_half-width=1")
+def modulation_contrast(raw_imp, sir_imp, do_map):
+    output, log = run_plugin(Raw_ModContrast(), [raw_imp], angles=3, phases=5, zw=1)
+    mcn_imp = output[0]
 
     output_images = []
     if do_map:
-        IJ.run("Modulation Contrast Map",
-               "calculate_mcnr_from_raw_data=" +
-               raw_image_title +
-               " camera_bit_depth=16 or,_specify_mcnr_stack=" +
-               raw_image_title.rsplit('.', 1)[0] +
-               "_MCN reconstructed_data_stack=" +
-               sir_image_title)
-        IJ.selectWindow(sir_image_title.rsplit('.', 1)[0] + '_MCM')
-        mcm_imp = IJ.getImage()
-        output_images.append(mcm_imp)
-
-    IJ.selectWindow(raw_image_title.rsplit('.', 1)[0] + '_MCN')
-    mcn_imp = IJ.getImage()
-    IJ.setMinAndMax(0, 255)
-    IJ.run("8-bit")
+        mcm_output, mcm_log = run_plugin(Rec_ModContrastMap(), [raw_imp, sir_imp, mcn_imp],
+                                         angles=3, phases=5, camBitDepth=16)
+        output_images += mcm_output
+
+    mcn_imp.setDisplayRange(0, 255)
+    ImageConverter(mcn_imp).convertToGray8()
     output_images.append(mcn_imp)
 
-    statistics = {}
-    statistics.update(parse_log('average feature MCNR = '))
-    statistics.update(parse_log('estimated Wiener filter optimum = '))
+    statistics = parse_measurements(log, ['average feature MCNR',
+                                          'estimated Wiener filter optimum'])
 
     return output_images, statistics
 
 
 # Reconstructed image analysis
-def intensity_histogram(image_title):
-    IJ.selectWindow(image_title)
-    IJ.run("Intensity Histogram", " ")
+def intensity_histogram(sir_imp):
+    output, log = run_plugin(Rec_IntensityHistogram(), [sir_imp])
+    for imp in output:
+        imp.close()
 
-    statistics = {}
-    statistics.update(parse_log('max-to-min intensity ratio = '))
+    statistics = parse_measurements(log, ['max-to-min intensity ratio'])
 
     return  statistics
 
-def spherical_aberration_mismatch(image_title):
-    IJ.selectWindow(image_title)
-    IJ.run("Spherical Aberration Mismatch", " ")
-    IJ.selectWindow(image_title.rsplit('.', 1)[0] + '_SAM')
-    sam_imp = IJ.getImage()
-  
-    statistics = {}
-    statistics.update(parse_log('Z-minimum variation = '))
+def spherical_aberration_mismatch(sir_imp):
+    output, log = run_plugin(Rec_SAMismatch(), [sir_imp])
 
-    return [sam_imp],statistics
+    statistics = parse_measurements(log, ['Z-minimum variation'])
 
+    return output, statistics
 
 
-def fourier_plots(image_title):
-    IJ.selectWindow(image_title)
-    IJ.run("Fourier Plots", "applyWinFunc=True")
 
-    IJ.selectWindow(image_title.rsplit('.', 1)[0] + '_FTL')
-    ftl_imp = IJ.getImage()
-    
-    # IJ.run("To ROI Manager")
-    # TODO: add ROIs to fourier plots
+def fourier_plots(sir_imp):
+    output, log = run_plugin(Rec_FourierPlots(), [sir_imp], applyWinFunc=True)
 
-    IJ.selectWindow(image_title.rsplit('.', 1)[0] + '_FTR')
+    # TODO: add ROIs to fourier plots
     # TODO: convert to RGB
-    ftr_imp = IJ.getImage()
-
-    return [ftl_imp, ftr_imp]
-
-
-def main_function():
-    # Clean up
-    IJ.run("Close All")
-    # TODO: condition closing or reseting log window to the fact that it is open
-    # IJ.selectWindow("Log")
-    # IJ.run("Close")
-
-    # Connect to OMERO
-    gateway = omero_connect(omero_server, omero_port, user_name, user_pw)
-
-    # Get Images IDs and names
-    images_dict = get_image_properties(gateway, dataset_id, group_id)
-
-    images = [(images_dict[id]['name'], id) for id in images_dict]
-
-    # Sort and get image names
-    images.sort(key=itemgetter(0))
-    
-    # We are assuming here a standard OMX naming pattern for raw and sim images
-    sim_images = [i[0] for i in images if i[0].endswith(sim_subfix)]
-    raw_images = [i.rstrip(sim_subfix) + raw_subfix for i in sim_images]
-    sim_images_ids = [i for i in images if i[0] in sim_images]
-    raw_images_ids = [i for i in images if i[0] in raw_images]
-
-    if len(sim_images_ids) != len(raw_images_ids):
-        print("Some of the images do not have a raw-sim correspondance")
-        gateway.disconnect()
-        print("Script has been aborted")
-        return
-
-    # Iterate through the list of images to analyze
-    for i in range(len(sim_images_ids)):
-        raw_image_title = raw_images_ids[i][0]
-        raw_image_id = raw_images_ids[i][1]
-        sim_image_title = sim_images_ids[i][0]
-        sim_image_id = sim_images_ids[i][1]
-
-        print("Analyzing RAW image: " + raw_image_title + " with id: " + str(raw_image_id))
-        print("Analyzing SIM image: " + sim_image_title + " with id: " + str(sim_image_id))
-
-        #Reset raw_imp and sim_imp so we can test to see if we have downloaded
-        # the relevant image later
-        raw_imp = None
-        sim_imp = None
-        log_window = None
-        raw_image_measurements = {}
-        sim_image_measurements = {}
-        output_images = []
-
-        if (do_channel_intensity_profiles and
-                 not ((raw_image_title.rsplit('.', 1)[0] + '_CIP.ome.tiff') in
-                      map(lambda x: x[0], images))):
-            
-            if raw_imp is None :
-                open_image_plus(omero_server,user_name,user_pw,
-                                group_id,raw_image_id)
-                IJ.selectWindow(raw_image_title)
-                raw_imp = IJ.getImage()
-            output, measurement = channel_intensity_profiles(raw_image_title)
-            raw_image_measurements.update(measurement)
-            log_window = True
-            output_images += output
-
-        if (do_fourier_projections and
-            not ((raw_image_title.rsplit('.', 1)[0] + '_FPJ.ome.tiff') in
-                      map(lambda x: x[0], images))):
-            if raw_imp is None :
-                open_image_plus(omero_server,user_name,user_pw,
-                                group_id,raw_image_id)
-                IJ.selectWindow(raw_image_title)
-                raw_imp = IJ.getImage()
-            output_images += fourier_projections(raw_image_title)
-
-        if (do_motion_illumination_variation and
-            not ((raw_image_title.rsplit('.', 1)[0] + '_MIV.ome.tiff') in
-                      map(lambda x: x[0], images))):
-            if raw_imp is None :
-                open_image_plus(omero_server,user_name,user_pw,
-                                group_id,raw_image_id)
-                IJ.selectWindow(raw_image_title)
-                raw_imp = IJ.getImage()
-            output_images += motion_illumination_variation(raw_image_title)
-
-        if ((do_modulation_contrast or do_modulation_contrast_map) and
-            not ((raw_image_title.rsplit('.', 1)[0] + '_MCN.ome.tiff') in
-                      map(lambda x: x[0], images))):
-            if raw_imp is None :
-                open_image_plus(omero_server,user_name,user_pw,
-                                group_id,raw_image_id)
-                IJ.selectWindow(raw_image_title)
-                raw_imp = IJ.getImage()
-            if sim_imp is None :
-                open_image_plus(omero_server,user_name,
-                                user_pw,group_id,sim_image_id)
-                IJ.selectWindow(sim_image_title)
-                sim_imp = IJ.getImage()
-            output, measurement = modulation_contrast(raw_image_title,
-                                                      sim_image_title,
-                                                      do_modulation_contrast_map)
-            raw_image_measurements.update(measurement)
-            log_window = True
-            output_images += output
+    return output
+
+
+# Suffixes of the images produced by the analyses of the raw and of the SIR images
+RAW_OUTPUTS = ('CIP', 'FPJ', 'MIV', 'MCN')
+SIR_OUTPUTS = ('MCM', 'SAM', 'FTL', 'FTR')
+
+
+class ProcessedIndex(object):
+    """Index of the analyses already done, keyed by (source image id, analysis).
+
+    For the analyses producing images the listing of the outputs on the
+    server is authoritative, so that outputs deleted on the server are
+    produced again. The listing reads only image names, in one query per
+    dataset. Analyses producing only measurements cannot be seen in a listing:
+    if a path is given they are recorded in an append-only log so that an
+    interrupted run does not redo them.
+    """
+
+    def __init__(self, path=None):
+        self._processed = set()
+        self._logged = set()
+        self._lock = threading.Lock()
+        self._log = None
+        if path:
+            if os.path.exists(path):
+                with open(path) as log_file:
+                    for line in log_file:
+                        fields = line.split()
+                        if len(fields) == 2:
+                            self._logged.add((long(fields[0]), fields[1]))
+            self._log = open(path, 'a')
+
+    def add_listing(self, images, sources):
+        """Indexes the derived images of a listing.
+
+        :param images: a list of (name, id) tuples. They may come from any dataset
+        :param sources: a {name: id} dictionary of the images that were analyzed
+        """
+        source_ids = dict((name.rsplit('.', 1)[0], ID) for name, ID in sources.items())
+        with self._lock:
+            for name, ID in images:
+                if not name.endswith('.ome.tiff'):
+                    continue
+                base, separator, analysis = name[:-len('.ome.tiff')].rpartition('_')
+                if separator and base in source_ids and analysis in RAW_OUTPUTS + SIR_OUTPUTS:
+                    self._processed.add((source_ids[base], analysis))
+
+    def is_processed(self, image_id, analysis):
+        key = (long(image_id), analysis)
+        if key in self._processed:
+            return True
+        return analysis not in RAW_OUTPUTS + SIR_OUTPUTS and key in self._logged
+
+    def mark_processed(self, image_id, analysis):
+        key = (long(image_id), analysis)
+        with self._lock:
+            self._processed.add(key)
+            if self._log is not None and analysis not in RAW_OUTPUTS + SIR_OUTPUTS:
+                self._log.write(str(key[0]) + ' ' + analysis + '\n')
+                self._log.flush()
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+
+def open_image(session, image_id):
+    """Downloads an image without showing it.
+
+    SIMcheck plugins read every plane several times, so the image is always
+    fully downloaded once rather than loaded lazily.
+    """
+    # Each image used to be opened through its own login to the server
+    session.count_saved_login()
+    return get_image_plus(session.get_gateway(), image_id, group_id)
+
+
+class ImageSource(object):
+    """An OMERO image that is only downloaded the first time an analysis needs it,
+    unless it was already prefetched"""
+
+    def __init__(self, session, image_id, imp=None):
+        self.session = session
+        self.image_id = image_id
+        self._imp = imp
+        self._fingerprint = None
+
+    def get(self):
+        if self._imp is None:
+            self._imp = open_image(self.session, self.image_id)
+        return self._imp
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = get_image_fingerprint(self.session.get_gateway(),
+                                                      self.image_id, group_id)
+        return self._fingerprint
+
+    def release(self):
+        """Releases the pixels"""
+        if self._imp is not None:
+            self._imp.flush()
+            self._imp = None
+
+
+def run_analysis(cache, sources, analysis, parameters, compute):
+    """Returns the (images, measurements) of an analysis, from the cache if possible.
+
+    The result is cached under the first source and the fingerprints of all
+    the sources. compute is only called, and the pixels only downloaded, on a
+    cache miss.
+    """
+    if cache is not None:
+        fingerprint = ' '.join([source.fingerprint() for source in sources])
+        cached = cache.get(sources[0].image_id, fingerprint, analysis, parameters)
+        if cached is not None:
+            return cached
+    images, measurements = compute()
+    if cache is not None:
+        cache.put(sources[0].image_id, fingerprint, analysis, parameters,
+                  images, measurements)
+
+    return images, measurements
+
+
+def build_analysis_plan(raw_image_id, sim_image_id, index):
+    """Returns the analyses to run on a pair, in the order they should run.
+
+    Each step is a dictionary with the analysis name, the images it reads
+    ('raw' and/or 'sim'), its parameters, the image its measurements belong to
+    and a compute function taking the input ImagePlus objects and returning
+    (images, measurements). Analyses reading only the raw image come first
+    and those reading only the SIR image last so that each image can be
+    released as soon as its last analysis is done.
+    """
+    steps = []
+
+    def add(name, inputs, parameters, target, compute):
+        steps.append({'name': name,
+                      'inputs': inputs,
+                      'parameters': parameters,
+                      'target': target,
+                      'compute': compute})
+
+    if do_channel_intensity_profiles and not index.is_processed(raw_image_id, 'CIP'):
+        add('CIP', ('raw',), 'angles=3 phases=5', 'raw',
+            lambda raw_imp: channel_intensity_profiles(raw_imp))
+    if do_fourier_projections and not index.is_processed(raw_image_id, 'FPJ'):
+        add('FPJ', ('raw',), 'angles=3 phases=5', 'raw',
+            lambda raw_imp: (fourier_projections(raw_imp), {}))
+    if do_motion_illumination_variation and not index.is_processed(raw_image_id, 'MIV'):
+        add('MIV', ('raw',), 'angles=3 phases=5', 'raw',
+            lambda raw_imp: (motion_illumination_variation(raw_imp), {}))
+    if ((do_modulation_contrast or do_modulation_contrast_map) and
+            not index.is_processed(raw_image_id, 'MCN')):
+        add('MCN', ('raw', 'sim'),
+            'angles=3 phases=5 z_window_half-width=1 map=' + str(do_modulation_contrast_map),
+            'raw',
+            lambda raw_imp, sim_imp: modulation_contrast(raw_imp, sim_imp,
+                                                         do_modulation_contrast_map))
+    if do_intensity_histogram and not index.is_processed(sim_image_id, 'HIS'):
+        add('HIS', ('sim',), '', 'sim',
+            lambda sim_imp: ([], intensity_histogram(sim_imp)))
+    if do_spherical_aberration_mismatch and not index.is_processed(sim_image_id, 'SAM'):
+        add('SAM', ('sim',), '', 'sim',
+            lambda sim_imp: spherical_aberration_mismatch(sim_imp))
+    if do_fourier_plots and not index.is_processed(sim_image_id, 'FTL'):
+        add('FTL', ('sim',), 'applyWinFunc=True', 'sim',
+            lambda sim_imp: (fourier_plots(sim_imp), {}))
+
+    # Remember the last step reading each image
+    for i in range(len(steps)):
+        steps[i]['release'] = [name for name in steps[i]['inputs']
+                               if not [step for step in steps[i + 1:] if name in step['inputs']]]
+
+    return steps
+
+
+def _marker(index, image_id, analyses):
+    """Returns a callback marking the analyses of an image as processed"""
+    def mark():
+        for analysis in analyses:
+            index.mark_processed(image_id, analysis)
+    return mark
+
+
+def analyze_pair(session, writer, raw_image, sim_image, index, cache=None, images=None):
+    """Runs the selected analyses on a raw/SIR pair.
+
+    Each image is downloaded at most once, shared by all the analyses reading
+    it and released after the last of them. The pair owns its ImagePlus
+    objects and never uses the window manager so that several pairs can be
+    analyzed at the same time.
+    images may hold the already downloaded 'raw' and 'sim' ImagePlus objects.
+    """
+    raw_image_title, raw_image_id = raw_image
+    sim_image_title, sim_image_id = sim_image
+
+    print("Analyzing RAW image: " + raw_image_title + " with id: " + str(raw_image_id))
+    print("Analyzing SIM image: " + sim_image_title + " with id: " + str(sim_image_id))
+
+    plan = build_analysis_plan(raw_image_id, sim_image_id, index)
+    images = images or {}
+    sources = {'raw': ImageSource(session, raw_image_id, images.get('raw')),
+               'sim': ImageSource(session, sim_image_id, images.get('sim'))}
+    measurements = {'raw': {}, 'sim': {}}
+    # Analyses producing only measurements are indexed once these are saved
+    measured = {'raw': [], 'sim': []}
+    output_images = []
 
-        if do_intensity_histogram:
-            if sim_imp is None :
-                open_image_plus(omero_server,user_name,
-                                user_pw,group_id,sim_image_id)
-                IJ.selectWindow(sim_image_title)
-                sim_imp = IJ.getImage()
-            measurement = intensity_histogram(sim_image_title)
-            print ( measurement)
-            log_window = True
-            sim_image_measurements.update(measurement)
-
-        if (do_spherical_aberration_mismatch  and 
-            not ((sim_image_title.rsplit('.', 1)[0] + '_SAM.ome.tiff') in
-                      map(lambda x: x[0], images))):
-            if sim_imp is None :
-                open_image_plus(omero_server,user_name,
-                                user_pw,group_id,sim_image_id)
-                IJ.selectWindow(sim_image_title)
-                sim_imp = IJ.getImage()
-            output, measurement = spherical_aberration_mismatch(sim_image_title)
-            log_window = True
-            print ( measurement)
+    try:
+        for step in plan:
+            inputs = [sources[name] for name in step['inputs']]
+            compute = lambda: step['compute'](*[source.get() for source in inputs])
+            output, measurement = run_analysis(cache, inputs, step['name'],
+                                               step['parameters'], compute)
             output_images += output
-            sim_image_measurements.update(measurement)
-
-            
-        if (do_fourier_plots and 
-            not ((sim_image_title.rsplit('.', 1)[0] + '_FTL.ome.tiff') in
-                      map(lambda x: x[0], images))):
-            if sim_imp is None :
-                open_image_plus(omero_server,user_name,
-                                user_pw,group_id,sim_image_id)
-                IJ.selectWindow(sim_image_title)
-                sim_imp = IJ.getImage()
-            output_images += fourier_plots(sim_image_title)
-
-        if raw_image_measurements:
-            add_images_key_values(gateway, raw_image_measurements, raw_image_id,
-                              group_id, "SIMcheck")
-        if sim_image_measurements:
-            add_images_key_values(gateway, sim_image_measurements, sim_image_id,
-                              group_id, "SIMcheck")
+            measurements[step['target']].update(measurement)
+            if not output:
+                measured[step['target']].append(step['name'])
+            for name in step['release']:
+                sources[name].release()
+
+        for name, image_id in (('raw', raw_image_id), ('sim', sim_image_id)):
+            if measurements[name]:
+                print(measurements[name])
+                # One annotation per channel. The analyses are marked once the last is saved
+                by_channel = sorted(measurements_by_channel(measurements[name]).items())
+                for i, (channel, channel_measurements) in enumerate(by_channel):
+                    description = "SIMcheck"
+                    if channel is not None:
+                        description += " C" + str(channel)
+                    on_success = None
+                    if i == len(by_channel) - 1:
+                        on_success = _marker(index, image_id, measured[name])
+                    writer.add_images_key_values(channel_measurements, image_id,
+                                                 group_id, description, on_success)
 
         for output_image in output_images:
-        
-            image_title = output_image.getTitle() + ".ome.tiff"
-            image_path = os.path.join(str(temp_path), image_title)
-            IJ.run(output_image, 'Bio-Formats Exporter', 'save=' + image_path + ' export compression=Uncompressed')
+            analysis = output_image.getTitle().rsplit('_', 1)[-1]
+            if analysis in RAW_OUTPUTS:
+                source_id = raw_image_id
+            else:
+                source_id = sim_image_id
+            # Upload image to OMERO through a compressed temporary file
+            writer.upload_image_plus(output_image, omero_server, dataset_id,
+                                     compression, str(temp_path),
+                                     on_success=_marker(index, source_id, [analysis]))
+
+    finally:
+        for output_image in output_images:
             output_image.changes = False
             output_image.close()
-            # Upload image to OMERO
-            print('Success: ' + str(upload_image(gateway, image_path, omero_server, dataset_id)))
+        for source in sources.values():
+            source.release()
+
+
+def prefetch_pair(session, pair, index, cache):
+    """Downloads the images of a pair that its analysis plan will read.
+
+    Images whose analyses are all cached are not downloaded.
+    """
+    (raw_image_title, raw_image_id), (sim_image_title, sim_image_id) = pair
+    sources = {'raw': ImageSource(session, raw_image_id),
+               'sim': ImageSource(session, sim_image_id)}
+    needed = set()
+    for step in build_analysis_plan(raw_image_id, sim_image_id, index):
+        inputs = [sources[name] for name in step['inputs']]
+        if cache is not None:
+            fingerprint = ' '.join([source.fingerprint() for source in inputs])
+            if cache.contains(inputs[0].image_id, fingerprint, step['name'], step['parameters']):
+                continue
+        needed.update(step['inputs'])
+
+    return dict((name, sources[name].get()) for name in needed)
+
+
+def run_in_pool(prefetcher, pool_size, task):
+    """Calls task(raw_image, sim_image, images) for every pair of the prefetcher
+    from pool_size worker threads"""
+
+    def work():
+        while True:
+            try:
+                (raw_image, sim_image), images = prefetcher.next()
+            except StopIteration:
+                return
+            try:
+                task(raw_image, sim_image, images)
+            except Exception as e:
+                print("Analysis of " + raw_image[0] + " and " + sim_image[0] + " failed: " + str(e))
+            finally:
+                prefetcher.release(images)
+
+    workers = [threading.Thread(target=work, name='simcheck-worker-' + str(i))
+               for i in range(max(1, pool_size))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
-        # Clean up close widnows that have been opened 
-        if sim_imp or raw_imp:
-            IJ.run("Close All")
-        #close log window if it exists
-        if log_window:
-            IJ.selectWindow("Log")
-            IJ.run("Close")
 
+def main_function():
+    # Output images of the plugins are never displayed
+    batch_mode = Interpreter.batchMode
+    Interpreter.batchMode = True
+    try:
+        return analyze_dataset()
+    finally:
+        Interpreter.batchMode = batch_mode
+
+
+def analyze_dataset():
+    # Connect to OMERO. The same session is reused to open every image
+    session = get_omero_session(omero_server, omero_port, user_name, user_pw)
+    gateway = session.get_gateway()
+    # Writes to OMERO are done in the background while the next pair is analyzed
+    writer = WriteBehindQueue(session)
+
+    # Pair raw and sim images. We are assuming here a standard OMX naming pattern
+    pairs, raw_orphans, sim_orphans = pair_images(gateway, dataset_id, group_id,
+                                                  raw_subfix, sim_subfix)
+    for name, image_id in raw_orphans + sim_orphans:
+        print("Image " + name + " with id: " + str(image_id) + " has no raw-sim correspondance")
+
+    # Index the outputs of previous runs, in this dataset and in any other listed.
+    # The analyses producing only measurements are read from the log of previous runs
+    index_path = None
+    if persist_index:
+        index_path = os.path.join(str(temp_path), 'SIMcheck_' + str(dataset_id) + '.log')
+    index = ProcessedIndex(index_path)
+    sources = dict([pair[0] for pair in pairs] + [pair[1] for pair in pairs])
+    for output_dataset_id in [dataset_id] + [int(d) for d in output_dataset_ids.split(',') if d.strip()]:
+        index.add_listing([(image['name'], image['id'])
+                           for image in iter_images(gateway, output_dataset_id, group_id,
+                                                    name_like=['%.ome.tiff'])],
+                          sources)
+
+    # Results of previous runs on unchanged pixels are reused from the local cache
+    cache = None
+    if use_cache:
+        cache = ResultCache(os.path.join(str(temp_path), 'SIMcheck_cache'),
+                            cache_size * 1024 * 1024)
+
+    # The next pairs are downloaded while the current ones are analyzed
+    if prefetch_depth > 0:
+        load = lambda pair: prefetch_pair(session, pair, index, cache)
+    else:
+        load = lambda pair: {}
+    spill_dir = None
+    if prefetch_spill:
+        spill_dir = str(temp_path)
+    # The size of a pair is known from its metadata before it is downloaded
+    estimate = lambda pair: sum([get_image_memory_size(session.get_gateway(), image_id, group_id)
+                                 for name, image_id in pair])
+    if spill_dir:
+        estimate = None
+    prefetcher = Prefetcher(pairs, load, prefetch_depth,
+                            prefetch_memory * 1024 * 1024, spill_dir, estimate)
+
+    # Analyze the pairs, several of them at the same time if requested
+    run_in_pool(prefetcher, pool_size,
+                lambda raw_image, sim_image, images: analyze_pair(session, writer, raw_image,
+                                                                  sim_image, index, cache,
+                                                                  images))
+
+    report = writer.close()
+    index.close()
     print("Done")
-    return gateway.disconnect()
+    print(str(report['done']) + " writes to OMERO done, " +
+          str(len(report['failures'])) + " failed")
+    for description, error in report['failures']:
+        print("Failed " + description + ": " + error)
+    if cache is not None:
+        cache.close()
+        print(cache.report())
+    print(session.report())
+    return session.disconnect()
 
 # get OMERO credentials
 #@string(label="Server", value="omero.mri.cnrs.fr", persist=true) omero_server
@@ -306,10 +576,20 @@ def main_function():
 
 # get the path for a temporary directory to store files
 #@File(label="Select a temporary directory", style="directory") temp_path
+#@string(label="Compression of uploaded images", choices={"LZW", "zlib", "Uncompressed"}, value="LZW") compression
 
 # get Dataset id
 #@int(label="Dataset ID") dataset_id
 #@int(label="Group ID") group_id
+#@string(label="IDs of other datasets holding outputs, comma separated", value="", required=false) output_dataset_ids
+#@boolean(label='Log the measured images in the temporary directory', value=true, persist=true) persist_index
+#@boolean(label='Cache results in the temporary directory', value=false, persist=true) use_cache
+#@int(label='Maximum size of the result cache (MB)', value=2048, persist=true) cache_size
+
+#@int(label='Number of pairs analyzed in parallel', value=1, min=1, persist=true) pool_size
+#@int(label='Number of pairs downloaded ahead', value=1, min=0, persist=true) prefetch_depth
+#@int(label='Memory for downloaded pairs (MB)', value=4096, persist=true) prefetch_memory
+#@boolean(label='Spill downloaded pairs to the temporary directory when out of memory', value=false, persist=true) prefetch_spill
 
 #@string(value='.dv') raw_subfix
 #@string(value='_SIR.dv') sim_subfix
@@ -2,11 +2,26 @@ from java.lang import String
 from java.lang import Long
 from java.lang import Float
 from java.lang import Double
+from java.lang import Integer
 from java.lang.Long import longValue
 from java.util import ArrayList
+from java.util import Arrays
+from java.util.concurrent import Executors
+from java.io import File
+from java.nio import ByteBuffer
 from jarray import array
+from jarray import zeros
 from java.lang.reflect import Array
 import java
+import threading
+import time
+import atexit
+import Queue
+import os
+import shutil
+import tempfile
+import json
+import hashlib
 
 # Preparations
 # Drop omero_client.jar and Blitz.jar under the jars folder of FIJI
@@ -41,6 +56,14 @@ from omero.model import NamedValue
 from omero.model import ProjectAnnotationLinkI
 from omero.model import DatasetAnnotationLinkI
 from omero.model import ImageAnnotationLinkI
+from omero.model import FileAnnotationI
+from omero.grid import StringColumn
+from omero.grid import LongColumn
+from omero.grid import DoubleColumn
+from omero.constants.namespaces import NSBULKANNOTATIONS
+from omero import rtypes
+from omero.model.enums import UnitsLength
+from omero.sys import ParametersI
 
 from ome.formats.importer import ImportConfig
 from ome.formats.importer import OMEROWrapper
@@ -52,21 +75,35 @@ import loci.common
 from loci.formats.in import DefaultMetadataOptions
 from loci.formats.in import MetadataLevel
 from ij import IJ
+from ij import ImagePlus
+from ij import ImageStack
+from ij.io import FileSaver
+from ij.process import ByteProcessor
+from ij.process import ShortProcessor
+from ij.process import FloatProcessor
 
 TYPES_DICT = {'String':String,
               'Long':Long,
               'Float':Float,
               'Double':Double}
 
-def open_image_plus(host, username, password, group_id, image_id):
+def open_image_plus(host, username, password, group_id, image_id, session_key=None):
+    """Opens an image through the Bio-Formats OMERO importer.
 
+    If a session_key is provided the importer joins that session instead of
+    logging in again with the username and password.
+    """
     options = ""
     options += "location=[OMERO] open=[omero:server="
     options += host
-    options += "\nuser="
-    options += username
-    options += "\npass="
-    options += password
+    if session_key:
+        options += "\nsessionID="
+        options += session_key
+    else:
+        options += "\nuser="
+        options += username
+        options += "\npass="
+        options += password
     options += "\ngroupID="
     options += String.valueOf(group_id)
     options += "\niid="
@@ -77,39 +114,577 @@ def open_image_plus(host, username, password, group_id, image_id):
     IJ.runPlugIn("loci.plugins.LociImporter", options)
 
 
+class OmeroSession(object):
+    """Owns one authenticated gateway and its session key.
+
+    The same gateway is handed out for browsing, pixel reads, annotation writes
+    and imports. A background thread keeps the session alive and, if the server
+    drops it, the next call to get_gateway reconnects transparently.
+    """
+
+    def __init__(self, host, port, user_name, user_password, keep_alive_interval=60):
+        self.host = host
+        self.port = port
+        self.user_name = user_name.strip()
+        self._user_password = user_password.strip()
+        self.keep_alive_interval = keep_alive_interval
+        self.gateway = None
+        self.user = None
+        self.session_key = None
+        self.logins = 0
+        self.logins_saved = 0
+        self.reconnections = 0
+        self._expired = False
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._keep_alive = None
+        self._importers = {}
+
+    def _credentials(self, session_key=None):
+        cred = LoginCredentials()
+        cred.getServer().setHostname(self.host)
+        cred.getServer().setPort(self.port)
+        if session_key:
+            # Joining an existing session uses the key as username and password
+            cred.getUser().setUsername(session_key)
+            cred.getUser().setPassword(session_key)
+        else:
+            cred.getUser().setUsername(self.user_name)
+            cred.getUser().setPassword(self._user_password)
+        return cred
+
+    def _connect(self, session_key=None):
+        gateway = Gateway(SimpleLogger())
+        self.user = gateway.connect(self._credentials(session_key))
+        self.gateway = gateway
+        self.session_key = gateway.getSessionId(self.user)
+        self._expired = False
+
+    def _login(self):
+        self._connect()
+        self.logins += 1
+        self._start_keep_alive()
+
+    def _reconnect(self):
+        """Tries to rejoin the current session and falls back to a full login"""
+        try:
+            self.gateway.disconnect()
+        except Exception:
+            pass
+        self.reconnections += 1
+        try:
+            self._connect(self.session_key)
+        except Exception:
+            self._connect()
+            self.logins += 1
+
+    def _start_keep_alive(self):
+        if self._keep_alive is not None or not self.keep_alive_interval:
+            return
+        self._stop.clear()
+        self._keep_alive = threading.Thread(target=self._keep_alive_loop,
+                                            name='omero-keep-alive')
+        self._keep_alive.setDaemon(True)
+        self._keep_alive.start()
+
+    def _keep_alive_loop(self):
+        while True:
+            self._stop.wait(self.keep_alive_interval)
+            if self._stop.isSet():
+                break
+            with self._lock:
+                try:
+                    if not self.gateway.isAlive(self.get_context()):
+                        self._expired = True
+                except Exception:
+                    self._expired = True
+
+    def get_gateway(self):
+        """Returns the shared gateway, logging in or reconnecting only if needed"""
+        with self._lock:
+            if self.gateway is None:
+                self._login()
+            elif self._expired or not self.gateway.isConnected():
+                self._reconnect()
+            return self.gateway
+
+    def count_saved_login(self):
+        """Records an operation, such as an image open or an import, that used
+        to log in on its own and now reuses the session"""
+        with self._lock:
+            self.logins_saved += 1
+
+    def get_session_key(self):
+        """Returns a valid session key so that other clients can join the session"""
+        self.get_gateway()
+        return self.session_key
+
+    def get_importer(self, host):
+        """Returns the importer joined to the current session, replacing it after a reconnection"""
+        with self._lock:
+            gateway = self.get_gateway()
+            importer = self._importers.get(host)
+            if importer is not None and importer.session_key != self.session_key:
+                importer.close()
+                importer = None
+            if importer is None:
+                importer = OmeroImporter(gateway, host)
+                self._importers[host] = importer
+            self.count_saved_login()
+            return importer
+
+    def get_context(self, group_id=None):
+        if group_id is None:
+            group_id = self.user.getGroupId()
+        return SecurityContext(group_id)
+
+    def report(self):
+        """Returns a dictionary with the login statistics of this session"""
+        return {'logins': self.logins,
+                'reconnections': self.reconnections,
+                'logins_saved': self.logins_saved}
+
+    def disconnect(self):
+        with self._lock:
+            self._stop.set()
+            self._keep_alive = None
+            for importer in self._importers.values():
+                importer.close()
+            self._importers = {}
+            if self.gateway is not None:
+                self.gateway.disconnect()
+            self.gateway = None
+            _SESSIONS.pop((self.host, self.port, self.user_name), None)
+
+
+_SESSIONS = {}
+
+
+def get_omero_session(host, port, user_name, user_password, keep_alive_interval=60):
+    """Returns the pooled session for these credentials, creating it if needed"""
+    key = (host, port, user_name.strip())
+    session = _SESSIONS.get(key)
+    if session is None:
+        session = OmeroSession(host, port, user_name, user_password, keep_alive_interval)
+        _SESSIONS[key] = session
+    return session
+
+
 def omero_connect(host, port, user_name, user_password):
-    """Omero Connect with credentials and simple_logger"""
+    """Omero Connect with credentials and simple_logger.
 
-    cred = LoginCredentials()
-    cred.getServer().setHostname(host)
-    cred.getServer().setPort(port)
-    cred.getUser().setUsername(user_name.strip())
-    cred.getUser().setPassword(user_password.strip())
-    simple_logger = SimpleLogger()
-    gateway = Gateway(simple_logger)
-    gateway.connect(cred)
-    return gateway
+    The gateway is taken from the session pool so that successive calls with
+    the same credentials reuse the same login.
+    """
+    return get_omero_session(host, port, user_name, user_password).get_gateway()
 
 
-def _get_images_browser(gateway, dataset_id, group_id):
+def _bytes_to_processor(data, pixel_type, width, height):
+    """Wraps a big-endian plane as returned by the RawPixelsStore into an ImageProcessor.
+
+    As in the Bio-Formats importer, signed 16-bit values are offset by 32768
+    to fit a ShortProcessor, and _calibrate sets the matching calibration.
+    Signed 8-bit and unsigned 32-bit values have no exact ImageJ type and are
+    returned in a FloatProcessor.
+    """
+    if pixel_type == 'uint8':
+        return ByteProcessor(width, height, data)
+    elif pixel_type == 'int8':
+        processor = ByteProcessor(width, height, data)
+        processor.xor(0x80)
+        processor = processor.convertToFloat()
+        processor.subtract(128)
+        return processor
+
+    buffer = ByteBuffer.wrap(data)
+    if pixel_type in ('int16', 'uint16'):
+        pixels = zeros(width * height, 'h')
+        buffer.asShortBuffer().get(pixels)
+        processor = ShortProcessor(width, height, pixels, None)
+        if pixel_type == 'int16':
+            # Flipping the sign bit adds 32768 to the signed values
+            processor.xor(0x8000)
+        return processor
+    elif pixel_type in ('int32', 'uint32'):
+        pixels = zeros(width * height, 'i')
+        buffer.asIntBuffer().get(pixels)
+        if pixel_type == 'uint32':
+            pixels = array([float(value & 0xFFFFFFFF) for value in pixels], 'f')
+        return FloatProcessor(width, height, pixels)
+    elif pixel_type == 'float':
+        pixels = zeros(width * height, 'f')
+        buffer.asFloatBuffer().get(pixels)
+        return FloatProcessor(width, height, pixels)
+    elif pixel_type == 'double':
+        pixels = zeros(width * height, 'd')
+        buffer.asDoubleBuffer().get(pixels)
+        return FloatProcessor(width, height, pixels)
+    else:
+        raise Exception('Pixel type not supported: ' + str(pixel_type))
+
+
+def _open_pixels(gateway, image_id, group_id):
+    """Returns the ImageData, its default PixelsData and a RawPixelsStore set on them"""
     browse = gateway.getFacility(BrowseFacility)
-    user = gateway.getLoggedInUser()
     ctx = SecurityContext(group_id)
-    ids = ArrayList(1)
-    val = Long(dataset_id)
-    ids.add(val)
-    images = browse.getImagesForDatasets(ctx, ids)
-    return images.iterator()
+    image = browse.getImage(ctx, Long(image_id))
+    pixels = image.getDefaultPixels()
+    store = gateway.getPixelsStore(ctx)
+    store.setPixelsId(pixels.getId(), False)
+
+    return image, pixels, store
+
+
+def _read_region(store, pixel_type, z, c, t, region, tile_size=None):
+    """Reads a region (x, y, width, height) of a plane, optionally tile by tile"""
+    x, y, width, height = region
+    if tile_size is None:
+        data = store.getTile(z, c, t, x, y, width, height)
+        return _bytes_to_processor(data, pixel_type, width, height)
+
+    processor = None
+    for tile_y in range(y, y + height, tile_size[1]):
+        for tile_x in range(x, x + width, tile_size[0]):
+            tile_width = min(tile_size[0], x + width - tile_x)
+            tile_height = min(tile_size[1], y + height - tile_y)
+            data = store.getTile(z, c, t, tile_x, tile_y, tile_width, tile_height)
+            tile = _bytes_to_processor(data, pixel_type, tile_width, tile_height)
+            if processor is None:
+                processor = tile.createProcessor(width, height)
+            processor.insert(tile, tile_x - x, tile_y - y)
+    return processor
+
+
+def _integer_list(values):
+    integers = ArrayList()
+    for value in values:
+        integers.add(Integer(value))
+    return integers
+
+
+def _read_stack(store, pixel_type, width, height, z_range, c, t, max_request_bytes):
+    """Reads the planes z_range of a channel and time-point in requests of at most
+    max_request_bytes, so that no reply exceeds the Ice message size limit.
+
+    Consecutive planes are read together with getHypercube. Planes larger than
+    the limit are read in bands of rows.
+    Returns a {z: ImageProcessor} dictionary.
+    """
+    byte_width = store.getByteWidth()
+    plane_size = width * height * byte_width
+    planes = {}
+    if plane_size > max_request_bytes:
+        band = (width, max(1, max_request_bytes // (width * byte_width)))
+        for z in z_range:
+            planes[z] = _read_region(store, pixel_type, z, c, t, (0, 0, width, height), band)
+        return planes
+
+    planes_per_request = max(1, max_request_bytes // plane_size)
+    runs = []
+    for z in z_range:
+        if runs and z == runs[-1][-1] + 1 and len(runs[-1]) < planes_per_request:
+            runs[-1].append(z)
+        else:
+            runs.append([z])
+    for run in runs:
+        data = store.getHypercube(_integer_list([0, 0, run[0], c, t]),
+                                  _integer_list([width, height, len(run), 1, 1]),
+                                  _integer_list([1, 1, 1, 1, 1]))
+        for i, z in enumerate(run):
+            plane = Arrays.copyOfRange(data, i * plane_size, (i + 1) * plane_size)
+            planes[z] = _bytes_to_processor(plane, pixel_type, width, height)
+    return planes
+
+
+def _calibrate(imp, pixels):
+    calibration = imp.getCalibration()
+    if pixels.getPixelType() == 'int16':
+        calibration.setSigned16BitCalibration()
+    try:
+        calibration.pixelWidth = pixels.getPixelSizeX(UnitsLength.MICROMETER).getValue()
+        calibration.pixelHeight = pixels.getPixelSizeY(UnitsLength.MICROMETER).getValue()
+        calibration.pixelDepth = pixels.getPixelSizeZ(UnitsLength.MICROMETER).getValue()
+        calibration.setUnit('micron')
+    except Exception:
+        # Physical sizes are optional in OMERO
+        pass
+
+
+# Replies must stay under the default Ice.MessageSizeMax of the OMERO client (64 MB)
+MAX_REQUEST_BYTES = 32 * 1024 * 1024
+
+
+def get_image_plus(gateway, image_id, group_id, z_range=None, c_range=None, t_range=None,
+                   tile_size=None, max_request_bytes=MAX_REQUEST_BYTES):
+    """Reads an image straight from the OMERO RawPixelsStore into an ImagePlus.
+
+    This avoids the LociImporter: no second login, no window is opened and the
+    original file is not parsed by Bio-Formats.
+
+    :param gateway: a gateway to the omero server
+    :param image_id: the id of the image
+    :param group_id: the id of the group the image belongs to
+    :param z_range: optional, the z indexes to read. Defaults to all of them
+    :param c_range: optional, the channel indexes to read. Defaults to all of them
+    :param t_range: optional, the time-point indexes to read. Defaults to all of them
+    :param tile_size: optional, a (width, height) tuple. When provided planes are
+        read tile by tile instead of several planes per request
+    :param max_request_bytes: the maximum size of the pixels read in one request
+    :return: an ImagePlus that is not shown
+    """
+    image, pixels, store = _open_pixels(gateway, image_id, group_id)
+    try:
+        width = pixels.getSizeX()
+        height = pixels.getSizeY()
+        pixel_type = pixels.getPixelType()
+        z_range = list(range(pixels.getSizeZ())) if z_range is None else list(z_range)
+        c_range = list(range(pixels.getSizeC())) if c_range is None else list(c_range)
+        t_range = list(range(pixels.getSizeT())) if t_range is None else list(t_range)
+
+        planes = {}
+        for t in t_range:
+            for c in c_range:
+                if tile_size is None:
+                    stack_planes = _read_stack(store, pixel_type, width, height, z_range, c, t,
+                                               max_request_bytes)
+                    for z in z_range:
+                        planes[(z, c, t)] = stack_planes[z]
+                else:
+                    for z in z_range:
+                        planes[(z, c, t)] = _read_region(store, pixel_type, z, c, t,
+                                                         (0, 0, width, height), tile_size)
+    finally:
+        store.close()
+
+    # ImageJ hyperstacks are ordered with channels varying fastest, then z, then t
+    stack = ImageStack(width, height)
+    for t in t_range:
+        for z in z_range:
+            for c in c_range:
+                stack.addSlice('c:' + str(c + 1) + ' z:' + str(z + 1) + ' t:' + str(t + 1),
+                               planes.pop((z, c, t)))
+
+    imp = ImagePlus(image.getName(), stack)
+    imp.setDimensions(len(c_range), len(z_range), len(t_range))
+    if imp.getNDimensions() > 3:
+        imp.setOpenAsHyperStack(True)
+    _calibrate(imp, pixels)
+
+    return imp
+
+
+def get_image_fingerprint(gateway, image_id, group_id):
+    """Returns a string identifying the current pixels of an image.
+
+    It is built from the pixels checksum and the time they were last updated,
+    so it changes whenever the pixels do. No pixel data is read.
+    """
+    query_service = gateway.getQueryService(SecurityContext(group_id))
+    params = ParametersI()
+    params.addId(image_id)
+    rows = query_service.projection("select p.sha1, e.time from Pixels p "
+                                    "join p.details.updateEvent e "
+                                    "where p.image.id = :id", params)
+    if rows.isEmpty():
+        raise Exception('Image ' + str(image_id) + ' has no pixels')
+    checksum, update_time = [value.getValue() if value is not None else None
+                             for value in rows.get(0)]
+
+    return str(checksum) + ':' + str(update_time)
+
+
+def get_image_memory_size(gateway, image_id, group_id):
+    """Returns the number of bytes an image takes once read into an ImagePlus.
+
+    It is computed from the pixels metadata, without reading any pixel data.
+    """
+    query_service = gateway.getQueryService(SecurityContext(group_id))
+    params = ParametersI()
+    params.addId(image_id)
+    rows = query_service.projection("select p.sizeX, p.sizeY, p.sizeZ, p.sizeC, p.sizeT, "
+                                    "t.value from Pixels p join p.pixelsType t "
+                                    "where p.image.id = :id", params)
+    if rows.isEmpty():
+        raise Exception('Image ' + str(image_id) + ' has no pixels')
+    size_x, size_y, size_z, size_c, size_t, pixel_type = [value.getValue()
+                                                          for value in rows.get(0)]
+    # As read by get_image_plus: 8 and 16 bit integers are kept, any other type is float
+    byte_width = {'uint8': 1, 'int16': 2, 'uint16': 2}.get(pixel_type, 4)
+
+    return long(size_x) * size_y * size_z * size_c * size_t * byte_width
+
+
+# Image properties that can be read with a projection query and their HQL path
+_IMAGE_FIELDS = {'name': 'i.name',
+                 'acquisition_date': 'i.acquisitionDate',
+                 'description': 'i.description',
+                 'fileset_id': 'fs.id',
+                 'index': 'i.series',
+                 'instrument_id': 'ins.id',
+                 'file_path': 'fe.clientPath',
+                 }
+
+
+def _unwrap(value):
+    if value is None:
+        return None
+    return value.getValue()
+
+
+# HQL sources of the images of a dataset, of a project and of a list of ids
+_DATASET_IMAGES = "DatasetImageLink l join l.child i"
+_PROJECT_IMAGES = ("ProjectDatasetLink pl join pl.child d join d.imageLinks l "
+                   "join l.child i")
+_IMAGES = "Image i"
+
+
+def _image_projection(fields, source, where):
+    """Returns an HQL projection of the image id followed by the requested fields"""
+    for field in fields:
+        if field not in _IMAGE_FIELDS:
+            raise Exception('Image field cannot be projected: ' + field)
+    columns = ['i.id'] + [_IMAGE_FIELDS[field] for field in fields]
+    joins = "left outer join i.fileset fs left outer join i.instrument ins "
+    if 'file_path' in fields:
+        # The path of an image is the client path of the first file of its fileset
+        joins += "left outer join fs.usedFiles fe "
+        where += (" and (fe is null or fe.id = "
+                  "(select min(e.id) from FilesetEntry e where e.fileset.id = fs.id))")
+
+    return ("select distinct " + ', '.join(columns) + " from " + source + " " + joins +
+            "where " + where + " order by i.id")
+
+
+def iter_images(gateway, dataset_id, group_id, fields=('name',), page_size=500, offset=0,
+                limit=None, name_like=None):
+    """Yields the images of a dataset, one page of results at a time.
+
+    Only the requested fields are read from the server so that processing can
+    start as soon as the first page arrives and memory does not grow with the
+    size of the dataset.
+
+    :param gateway: a gateway to the omero server
+    :param dataset_id: the id of the dataset
+    :param group_id: the id of the group the dataset belongs to
+    :param fields: the fields to read. Any of 'name', 'acquisition_date',
+        'description', 'fileset_id', 'index', 'instrument_id' and 'file_path'
+    :param page_size: the number of images requested at once
+    :param offset: the number of images to skip
+    :param limit: optional, the maximum number of images to yield
+    :param name_like: optional, a list of HQL 'like' patterns. Only the images
+        whose name matches one of them are read
+    :return: a generator of {'id': long, field: value...} dictionaries
+    """
+    query_service = gateway.getQueryService(SecurityContext(group_id))
+    params = ParametersI()
+    params.addId(dataset_id)
+    where = "l.parent.id = :id"
+    if name_like:
+        for i in range(len(name_like)):
+            params.addString('name' + str(i), name_like[i])
+        where += (" and (" +
+                  " or ".join(["i.name like :name" + str(i) for i in range(len(name_like))]) +
+                  ")")
+    query = _image_projection(fields, _DATASET_IMAGES, where)
+
+    yielded = 0
+    while limit is None or yielded < limit:
+        size = page_size if limit is None else min(page_size, limit - yielded)
+        params.page(offset + yielded, size)
+        rows = query_service.projection(query, params)
+        for row in rows:
+            image = {'id': _unwrap(row.get(0))}
+            for i in range(len(fields)):
+                image[fields[i]] = _unwrap(row.get(i + 1))
+            yield image
+        yielded += rows.size()
+        if rows.size() < size:
+            return
+
+
+def pair_images(gateway, dataset_id, group_id, first_suffix, second_suffix):
+    """Pairs the images of a dataset whose names only differ by their suffix.
+
+    Only the ids and names of the images ending with one of the suffixes are
+    read from the server. They are matched through a dictionary keyed by the
+    name without its suffix. When a name ends with both suffixes, the longest
+    one is used.
+
+    :return: a tuple with
+        - a list of ((first_name, first_id), (second_name, second_id)) pairs sorted by name
+        - a list of the (name, id) of the images with the first suffix and no match
+        - a list of the (name, id) of the images with the second suffix and no match
+    """
+    suffixes = sorted([first_suffix, second_suffix], key=len, reverse=True)
+    found = {first_suffix: {}, second_suffix: {}}
+    for image in iter_images(gateway, dataset_id, group_id,
+                             name_like=['%' + suffix for suffix in suffixes]):
+        for suffix in suffixes:
+            if image['name'].endswith(suffix):
+                found[suffix][image['name'][:-len(suffix)]] = (image['name'], image['id'])
+                break
+
+    firsts = found[first_suffix]
+    seconds = found[second_suffix]
+    pairs = [(firsts[base], seconds[base]) for base in sorted(firsts) if base in seconds]
+    first_orphans = [firsts[base] for base in sorted(firsts) if base not in seconds]
+    second_orphans = [seconds[base] for base in sorted(seconds) if base not in firsts]
+
+    return pairs, first_orphans, second_orphans
 
 
-def get_image_ids(gateway, dataset_id):
-    """Returns a list of all ImageId's under a Project/Dataset"""
+def get_image_ids(gateway, dataset_id, group_id=-1):
+    """Returns a list of all ImageId's under a Dataset"""
 
-    browser = _get_images_browser(gateway, dataset_id)
-    image_ids = [String.valueOf(image.getId()) for image in browser]
+    image_ids = [String.valueOf(image['id'])
+                 for image in iter_images(gateway, dataset_id, group_id, fields=())]
     return image_ids
 
 
+def get_image_columns(gateway, group_id, fields=('name',), dataset_id=None, project_id=None,
+                      image_ids=None):
+    """Reads some fields of many images in a single projection query.
+
+    The images are those of a dataset, of a project or a list of ids. Only the
+    requested fields are read and no ImageData object is built.
+
+    :param gateway: a gateway to the omero server
+    :param group_id: the id of the group the images belong to
+    :param fields: the fields to read. Any of 'name', 'acquisition_date',
+        'description', 'fileset_id', 'index', 'instrument_id' and 'file_path'
+    :param dataset_id: the id of a dataset
+    :param project_id: the id of a project
+    :param image_ids: a list of image ids
+    :return: a dictionary of parallel lists, one per field plus 'id', sorted by image id
+    """
+    params = ParametersI()
+    if dataset_id is not None:
+        params.addId(dataset_id)
+        query = _image_projection(fields, _DATASET_IMAGES, "l.parent.id = :id")
+    elif project_id is not None:
+        params.addId(project_id)
+        query = _image_projection(fields, _PROJECT_IMAGES, "pl.parent.id = :id")
+    elif image_ids is not None:
+        ids = ArrayList()
+        for image_id in image_ids:
+            ids.add(Long(image_id))
+        params.addIds(ids)
+        query = _image_projection(fields, _IMAGES, "i.id in (:ids)")
+    else:
+        raise Exception('A dataset, a project or a list of images is required')
+
+    rows = gateway.getQueryService(SecurityContext(group_id)).projection(query, params)
+    columns = {'id': []}
+    for field in fields:
+        columns[field] = []
+    for row in rows:
+        columns['id'].append(_unwrap(row.get(0)))
+        for i in range(len(fields)):
+            columns[fields[i]].append(_unwrap(row.get(i + 1)))
+
+    return columns
+
+
 def get_image_properties(gateway, dataset_id, group_id):
     """Returns a dictionary of dictionaries in the form:
     {long:{'name': str,
@@ -120,61 +695,186 @@ def get_image_properties(gateway, dataset_id, group_id):
            'instrument_id': ,
            'file_path': str,}
     under the specified Dataset
-    """
 
-    browser = _get_images_browser(gateway, dataset_id, group_id)
+    The properties are read with a single projection query, see get_image_columns.
+    """
+    fields = ('name', 'acquisition_date', 'description', 'fileset_id', 'index',
+              'instrument_id', 'file_path')
+    columns = get_image_columns(gateway, group_id, fields, dataset_id=dataset_id)
     image_properties = {}
-    for image in browser:
-        image_id = image.getId()
-        properties = {'name': image.getName(),
-                      'acquisition_date': image.getAcquisitionDate(),
-                      'description': image.getDescription(),
-                      'fileset_id': image.getFilesetId(),
-                      'index': image.getIndex(),
-                      'instrument_id': image.getInstrumentId(),
-                      'file_path': image.getPathToFile(),
-                      }
-        image_properties[image_id] = properties
+    for i in range(len(columns['id'])):
+        image_properties[columns['id'][i]] = dict((field, columns[field][i]) for field in fields)
     return image_properties
 
 
+class OmeroImporter(object):
+    """Imports files into OMERO reusing one configuration, metadata store,
+    reader and import library for any number of files.
+
+    :param gateway: a gateway to the omero server. Its session is joined by the importer
+    :param host: the omero server host
+    :param log_level: the Bio-Formats logging level, set once for the importer
+    """
+
+    def __init__(self, gateway, host, log_level='WARN'):
+        user = gateway.getLoggedInUser()
+        self.session_key = gateway.getSessionId(user)
+
+        config = ImportConfig()
+        config.email.set("")
+        config.sendFiles.set('true')
+        config.sendReport.set('false')
+        config.contOnError.set('true')
+        config.debug.set('false')
+        config.hostname.set(host)
+        config.sessionKey.set(self.session_key)
+        self.config = config
+
+        loci.common.DebugTools.enableLogging(log_level)
+
+        self.store = config.createStore()
+        self.reader = OMEROWrapper(config)
+        self.reader.setMetadataOptions(DefaultMetadataOptions(MetadataLevel.ALL))
+        self.library = ImportLibrary(self.store, self.reader)
+        self.library.addObserver(LoggingImportMonitor())
+        self.error_handler = ErrorHandler(config)
+        self._thread_pool = Executors.newSingleThreadExecutor()
+
+    def iter_import(self, paths, dataset_id):
+        """Imports the paths as one batch of candidates into the dataset.
+
+        Yields a (path, success) tuple as soon as each file has been imported.
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        str2d = Array.newInstance(String, [len(paths)])
+        for i in range(len(paths)):
+            str2d[i] = paths[i]
+        candidates = ImportCandidates(self.reader, str2d, self.error_handler)
+        target = DatasetI(Long(dataset_id), False)
+
+        pending = dict((File(path).getAbsolutePath(), path) for path in paths)
+        containers = candidates.getContainers()
+        for index in range(containers.size()):
+            container = containers.get(index)
+            container.setTarget(target)
+            path = pending.pop(container.getFile().getAbsolutePath(),
+                               container.getFile().getPath())
+            print('Importing image: ' + path)
+            try:
+                pixels = self.library.importImage(container, self._thread_pool, index)
+                success = pixels is not None and not pixels.isEmpty()
+            except Exception as e:
+                print(e)
+                success = False
+            yield path, success
+
+        # Files that could not be read are not import candidates
+        for path in pending.values():
+            yield path, False
+
+    def import_paths(self, paths, dataset_id):
+        """Imports the paths into the dataset and returns a {path: success} dictionary"""
+        return dict(self.iter_import(paths, dataset_id))
+
+    def close(self):
+        self._thread_pool.shutdown()
+        try:
+            self.store.logout()
+        except Exception:
+            # The session may already be gone
+            pass
+
+
+# Importers of gateways that do not belong to a pooled OmeroSession
+_IMPORTERS = {}
+
+
+def get_importer(gateway, host):
+    """Returns the importer joined to the session of the gateway, creating it if needed.
+
+    Importers of pooled sessions are owned by their OmeroSession and closed
+    when it disconnects. An importer is replaced when the session of its
+    gateway changes.
+    """
+    for session in _SESSIONS.values():
+        if session.gateway is gateway:
+            return session.get_importer(host)
+
+    session_key = gateway.getSessionId(gateway.getLoggedInUser())
+    importer = _IMPORTERS.get((host, gateway))
+    if importer is not None and importer.session_key != session_key:
+        importer.close()
+        importer = None
+    if importer is None:
+        importer = OmeroImporter(gateway, host)
+        _IMPORTERS[(host, gateway)] = importer
+    return importer
+
+
+def close_importers():
+    """Closes the importers of the gateways outside the session pool"""
+    for importer in _IMPORTERS.values():
+        importer.close()
+    _IMPORTERS.clear()
+
+
+atexit.register(close_importers)
+
+
+def upload_images(gateway, paths, host, dataset_id):
+    """Uploads many images to a dataset and returns a {path: success} dictionary"""
+    return get_importer(gateway, host).import_paths(paths, dataset_id)
+
+
 def upload_image(gateway, path, host, dataset_id):
+    """Uploads an image to a dataset and returns whether it succeeded"""
+    return upload_images(gateway, [path], host, dataset_id)[path]
 
-    user = gateway.getLoggedInUser()
-    ctx = SecurityContext(user.getGroupId())
-    session_key = gateway.getSessionId(user)
-    
-    str2d = Array.newInstance(String,[1])
-    str2d[0] = path
-    
-    config = ImportConfig()
-
-    config.email.set("")
-    config.sendFiles.set('true')
-    config.sendReport.set('false')
-    config.contOnError.set('false')
-    config.debug.set('false')
-    config.hostname.set(host)
-    config.sessionKey.set(session_key)
-    config.targetClass.set("omero.model.Dataset")
-    config.targetId.set(dataset_id)
-
-    loci.common.DebugTools.enableLogging("DEBUG")
-
-    store = config.createStore()
-    reader = OMEROWrapper(config)
-
-    library = ImportLibrary(store,reader)
-    error_handler = ErrorHandler(config)
-
-    library.addObserver(LoggingImportMonitor())
-    candidates = ImportCandidates(reader, str2d, error_handler)
-    reader.setMetadataOptions(DefaultMetadataOptions(MetadataLevel.ALL))
-    print('Importing image: ' + str2d[0])
-    success = library.importCandidates(config, candidates)
+
+def export_image_plus(imp, compression='LZW', temp_dir=None, name=None):
+    """Exports an ImagePlus as a compressed OME-TIFF into a new temporary directory.
+
+    :param imp: the ImagePlus to export
+    :param compression: a Bio-Formats Exporter compression: 'LZW', 'zlib' or 'Uncompressed'
+    :param temp_dir: optional, where the temporary directory is created
+    :param name: optional, the file name. Defaults to the image title
+    :return: the path to the exported file
+    """
+    if name is None:
+        name = imp.getTitle() + '.ome.tiff'
+    path = os.path.join(tempfile.mkdtemp(dir=temp_dir), name)
+    IJ.run(imp, 'Bio-Formats Exporter', 'save=[' + path + '] export compression=' + compression)
+
+    return path
+
+
+def _remove_export(path):
+    shutil.rmtree(os.path.dirname(path), True)
+
+
+def upload_exported_image(gateway, path, host, dataset_id):
+    """Uploads a file created by export_image_plus and removes it once imported"""
+    success = upload_image(gateway, path, host, dataset_id)
+    if success:
+        _remove_export(path)
     return success
 
 
+def upload_image_plus(gateway, imp, host, dataset_id, compression='LZW', temp_dir=None,
+                      name=None):
+    """Uploads an ImagePlus to a dataset.
+
+    The OMERO importer needs a file, so the image is spooled to a single
+    compressed OME-TIFF that is deleted as soon as the import is done.
+    """
+    path = export_image_plus(imp, compression, temp_dir, name)
+    try:
+        return upload_image(gateway, path, host, dataset_id)
+    finally:
+        _remove_export(path)
+
+
 def _data_manager_generator(gateway, group_id):
     data_manager = gateway.getFacility(DataManagerFacility)
     user = gateway.getLoggedInUser()
@@ -186,7 +886,7 @@ def _data_manager_generator(gateway, group_id):
 def _dict_to_map_annotation(dictionary, description=None):
     result = []
     for element in dictionary:
-        result.append(NamedValue(element, dictionary[element]))
+        result.append(NamedValue(element, str(dictionary[element])))
     map_data = MapAnnotationData()
     map_data.setContent(result)
     if description:
@@ -196,136 +896,207 @@ def _dict_to_map_annotation(dictionary, description=None):
     return map_data
 
 
-def add_projects_key_values(gateway, key_values, project_ids, group_id, description=None):
-    """Adds some key:value pairs to a list of images"""
-    map_data = _dict_to_map_annotation(key_values, description)
+def _link_existing_annotation(gateway, annotation, link_class, parent_class, parent_ids,
+                              group_id, chunk_size=None, failures=None):
+    """Links a saved annotation to many parents.
+
+    The links are saved in bulk, in a single call or in chunks of chunk_size
+    links, instead of one server round-trip per parent.
+    If a failures dictionary is provided, the parents of a chunk that could not
+    be saved are recorded in it with the error instead of raising it.
+    Returns the list of saved links.
+    """
+    if not hasattr(parent_ids, '__iter__'):
+        parent_ids = [parent_ids]
+    parent_ids = list(parent_ids)
+    links = []
+    for ID in parent_ids:
+        link = link_class()
+        link.setChild(annotation.proxy())
+        link.setParent(parent_class(ID, False))
+        links.append(link)
+
+    if not chunk_size:
+        chunk_size = max(len(links), 1)
+    update_service = gateway.getUpdateService(SecurityContext(group_id))
+    saved_links = []
+    for i in range(0, len(links), chunk_size):
+        try:
+            saved_links.extend(update_service.saveAndReturnArray(links[i:i + chunk_size]))
+        except Exception as e:
+            if failures is None:
+                raise
+            for ID in parent_ids[i:i + chunk_size]:
+                failures[ID] = e
+
+    return saved_links
+
 
+def _link_annotation(gateway, annotation, link_class, parent_class, parent_ids, group_id,
+                     chunk_size=None):
+    """Saves an annotation once and links it to many parents.
+    Returns the list of saved links.
+    """
     data_manager, ctx = _data_manager_generator(gateway, group_id)
+    annotation = data_manager.saveAndReturnObject(ctx, annotation)
 
-    # Link the data to the image
-    if not hasattr(project_ids, '__iter__'):
-        project_ids = [project_ids]
-    for ID in project_ids:
-        link = ProjectAnnotationLinkI()
-        link.setChild(map_data.asAnnotation())
-        link.setParent(ProjectI(ID, False))
-        data_manager.saveAndReturnObject(ctx, link)
+    return _link_existing_annotation(gateway, annotation, link_class, parent_class, parent_ids,
+                                     group_id, chunk_size)
 
 
-def add_datasets_key_values(gateway, key_values, dataset_ids, group_id, description=None):
-    """Adds some key:value pairs to a list of images"""
+def add_projects_key_values(gateway, key_values, project_ids, group_id, description=None,
+                            chunk_size=None):
+    """Adds some key:value pairs to a list of projects"""
     map_data = _dict_to_map_annotation(key_values, description)
 
-    data_manager, ctx = _data_manager_generator(gateway, group_id)
+    return _link_annotation(gateway, map_data.asAnnotation(), ProjectAnnotationLinkI, ProjectI,
+                            project_ids, group_id, chunk_size)
 
-    # Link the data to the image
-    if not hasattr(dataset_ids, '__iter__'):
-        dataset_ids = [dataset_ids]
-    for ID in dataset_ids:
-        link = DatasetAnnotationLinkI()
-        link.setChild(map_data.asAnnotation())
-        link.setParent(DatasetI(ID, False))
-        data_manager.saveAndReturnObject(ctx, link)
 
-
-def add_images_key_values(gateway, key_values, image_ids, group_id, description=None):
-    """Adds some key:value pairs to a list of images"""
+def add_datasets_key_values(gateway, key_values, dataset_ids, group_id, description=None,
+                            chunk_size=None):
+    """Adds some key:value pairs to a list of datasets"""
     map_data = _dict_to_map_annotation(key_values, description)
 
-    data_manager, ctx = _data_manager_generator(gateway, group_id)
+    return _link_annotation(gateway, map_data.asAnnotation(), DatasetAnnotationLinkI, DatasetI,
+                            dataset_ids, group_id, chunk_size)
 
-    # Link the data to the image
-    if not hasattr(image_ids, '__iter__'):
-        image_ids = [image_ids]
-    for ID in image_ids:
-        link = ImageAnnotationLinkI()
-        link.setChild(map_data.asAnnotation())
-        link.setParent(ImageI(ID, False))
-        data_manager.saveAndReturnObject(ctx, link)
 
+def add_images_key_values(gateway, key_values, image_ids, group_id, description=None,
+                          chunk_size=None):
+    """Adds some key:value pairs to a list of images"""
+    map_data = _dict_to_map_annotation(key_values, description)
 
-def add_project_tag(gateway, tag_text, project_id, description=None):
-    """Adds a tag to a project"""
-    data_manager = gateway.getFacility(DataManagerFacility)
-    user = gateway.getLoggedInUser()
-    ctx = SecurityContext(user.getGroupId())
+    return _link_annotation(gateway, map_data.asAnnotation(), ImageAnnotationLinkI, ImageI,
+                            image_ids, group_id, chunk_size)
 
-    # Arrange the data
+
+def _tag_annotation(tag_text, description=None):
     tag_data = TagAnnotationData(tag_text)
     if description:
         tag_data.setTagDescription(description)
 
-    # Link the data to the image
-    link = ProjectAnnotationLinkI()
-    link.setChild(tag_data.asAnnotation())
-    link.setParent(ProjectI(project_id, False))
+    return tag_data.asAnnotation()
 
-    return data_manager.saveAndReturnObject(ctx, link)
 
+def add_projects_tag(gateway, tag_text, project_ids, group_id, description=None,
+                     chunk_size=None):
+    """Adds a tag to a list of projects"""
+    return _link_annotation(gateway, _tag_annotation(tag_text, description),
+                            ProjectAnnotationLinkI, ProjectI, project_ids, group_id, chunk_size)
 
-def add_dataset_tag(gateway, tag_text, dataset_id, description=None):
-    """Adds a tag to a dataset"""
-    data_manager = gateway.getFacility(DataManagerFacility)
-    user = gateway.getLoggedInUser()
-    ctx = SecurityContext(user.getGroupId())
 
-    # Arrange the data
-    tag_data = TagAnnotationData(tag_text)
-    if description:
-        tag_data.setTagDescription(description)
+def add_datasets_tag(gateway, tag_text, dataset_ids, group_id, description=None,
+                     chunk_size=None):
+    """Adds a tag to a list of datasets"""
+    return _link_annotation(gateway, _tag_annotation(tag_text, description),
+                            DatasetAnnotationLinkI, DatasetI, dataset_ids, group_id, chunk_size)
+
+
+def add_images_tag(gateway, tag_text, image_ids, group_id, description=None,
+                   chunk_size=None):
+    """Adds a tag to a list of images"""
+    return _link_annotation(gateway, _tag_annotation(tag_text, description),
+                            ImageAnnotationLinkI, ImageI, image_ids, group_id, chunk_size)
 
-    # Link the data to the image
-    link = DatasetAnnotationLinkI()
-    link.setChild(tag_data.asAnnotation())
-    link.setParent(DatasetI(dataset_id, False))
 
-    return data_manager.saveAndReturnObject(ctx, link)
+def add_project_tag(gateway, tag_text, project_id, description=None):
+    """Adds a tag to a project"""
+    group_id = gateway.getLoggedInUser().getGroupId()
+
+    return add_projects_tag(gateway, tag_text, project_id, group_id, description)[0]
+
+
+def add_dataset_tag(gateway, tag_text, dataset_id, description=None):
+    """Adds a tag to a dataset"""
+    group_id = gateway.getLoggedInUser().getGroupId()
+
+    return add_datasets_tag(gateway, tag_text, dataset_id, group_id, description)[0]
 
 
 def add_image_tag(gateway, tag_text, image_id, description=None):
     """Adds a tag to an image"""
-    data_manager = gateway.getFacility(DataManagerFacility)
-    user = gateway.getLoggedInUser()
-    ctx = SecurityContext(user.getGroupId())
+    group_id = gateway.getLoggedInUser().getGroupId()
 
-    # Arrange the data
-    tag_data = TagAnnotationData(tag_text)
-    if description:
-        tag_data.setTagDescription(description)
+    return add_images_tag(gateway, tag_text, image_id, group_id, description)[0]
 
-    # Link the data to the image
-    link = ImageAnnotationLinkI()
-    link.setChild(tag_data.asAnnotation())
-    link.setParent(ImageI(image_id, False))
 
-    return data_manager.saveAndReturnObject(ctx, link)
+class TableAttachmentError(Exception):
+    """Raised when a table could not be attached to some of its targets.
 
+    failures holds a {target_id: error} dictionary.
+    """
 
-def _add_table(gateway, table_parameters, table_data, table_name, target):
-    """Appends a table to a target object"""
+    def __init__(self, failures):
+        Exception.__init__(self, 'The table could not be attached to ' +
+                           str(len(failures)) + ' target(s): ' + str(failures))
+        self.failures = failures
+
+
+def _build_table(table_parameters, table_data):
     # Verify consistency of tables
     if len(table_parameters) != len(table_data):
         raise Exception('Table parameters and data do not have the same length')
 
     columns = []
     for i in range(len(table_parameters)):
+        column_type = table_parameters[i][1]
         columns.append(TableDataColumn(table_parameters[i][0],
                                        i,
-                                       table_parameters[i][1]))
+                                       TYPES_DICT.get(column_type, column_type)))
         if len(table_parameters[i]) == 3:
             columns[-1].setDescription(table_parameters[i][2])
 
-    table = TableData(columns, table_data)
+    return TableData(columns, table_data)
+
+
+def _add_table(gateway, table_parameters, table_data, table_name, target):
+    """Appends a table to a target object"""
+    table = _build_table(table_parameters, table_data)
 
     facility = gateway.getFacility(TablesFacility)
     user = gateway.getLoggedInUser()
     ctx = SecurityContext(user.getGroupId())
 
-    facility.addTable(ctx, target, table_name, table)
+    return facility.addTable(ctx, target, table_name, table)
+
+
+def _get_table_annotation(gateway, group_id, file_id):
+    """Returns the file annotation of the original file of a table"""
+    params = ParametersI()
+    params.addId(file_id)
+    return gateway.getQueryService(SecurityContext(group_id)).findByQuery(
+        "select a from FileAnnotation a where a.file.id = :id", params)
+
+
+def _add_table_to_targets(gateway, table_parameters, table_data, table_name, target_ids,
+                          link_class, target_class, raise_errors=True):
+    """Uploads a table to the first target and links its file annotation to the others"""
+    if not hasattr(target_ids, '__iter__'):
+        target_ids = [target_ids]
+    target_ids = list(target_ids)
+    failures = {}
+    if target_ids:
+        try:
+            table = _add_table(gateway, table_parameters, table_data, table_name,
+                               target_class(target_ids[0], False))
+        except Exception as e:
+            failures = dict((ID, e) for ID in target_ids)
+        else:
+            group_id = gateway.getLoggedInUser().getGroupId()
+            if len(target_ids) > 1:
+                annotation = _get_table_annotation(gateway, group_id, table.getOriginalFileId())
+                _link_existing_annotation(gateway, annotation, link_class, target_class,
+                                          target_ids[1:], group_id, failures=failures)
+
+    if failures and raise_errors:
+        raise TableAttachmentError(failures)
+    return failures
 
 
-def add_project_table(gateway, table_parameters, table_data, table_name, project_ids):
-    """Appends a table to a project.
+def add_project_table(gateway, table_parameters, table_data, table_name, project_ids,
+                      raise_errors=True):
+    """Uploads a table once and attaches it to one or more projects.
 
     :param gateway: a gateway to the omero server
     :param table_parameters: a list of 2 or 3 element-tuples containing:
@@ -334,20 +1105,18 @@ def add_project_table(gateway, table_parameters, table_data, table_name, project
         3- optional, a string containing the description of the column
     :param table_data: a list of lists containing the data
     :param table_name: a string containing the table name. Must be unique
-    :param project_ids: the id (of list of ids) of the target project(s)
+    :param project_ids: the id (or list of ids) of the target project(s)
+    :param raise_errors: if True a TableAttachmentError is raised when the
+        table cannot be attached to some of the targets. Otherwise a
+        {id: error} dictionary of these targets is returned
     """
-    if not hasattr(project_ids, '__iter__'):
-        project_ids = [project_ids]
-    for project in project_ids:
-        target = ProjectI(project, False)
-        try:
-            _add_table(gateway, table_parameters, table_data, table_name, target)
-        except Exception as e:
-            print(e)
+    return _add_table_to_targets(gateway, table_parameters, table_data, table_name,
+                                 project_ids, ProjectAnnotationLinkI, ProjectI, raise_errors)
 
 
-def add_dataset_table(gateway, table_parameters, table_data, table_name, dataset_ids):
-    """Appends a table to a project.
+def add_dataset_table(gateway, table_parameters, table_data, table_name, dataset_ids,
+                      raise_errors=True):
+    """Uploads a table once and attaches it to one or more datasets.
 
     :param gateway: a gateway to the omero server
     :param table_parameters: a list of 2 or 3 element-tuples containing:
@@ -356,20 +1125,18 @@ def add_dataset_table(gateway, table_parameters, table_data, table_name, dataset
         3- optional, a string containing the description of the column
     :param table_data: a list of lists containing the data
     :param table_name: a string containing the table name. Must be unique
-    :param dataset_ids: the id (of list of ids) of the target dataset(s)
+    :param dataset_ids: the id (or list of ids) of the target dataset(s)
+    :param raise_errors: if True a TableAttachmentError is raised when the
+        table cannot be attached to some of the targets. Otherwise a
+        {id: error} dictionary of these targets is returned
     """
-    if not hasattr(dataset_ids, '__iter__'):
-        dataset_ids = [dataset_ids]
-    for dataset in dataset_ids:
-        target = DatasetI(dataset, False)
-        try:
-            _add_table(gateway, table_parameters, table_data, table_name, target)
-        except Exception as e:
-            print(e)
+    return _add_table_to_targets(gateway, table_parameters, table_data, table_name,
+                                 dataset_ids, DatasetAnnotationLinkI, DatasetI, raise_errors)
 
 
-def add_image_table(gateway, table_parameters, table_data, table_name, image_ids):
-    """Appends a table to a project.
+def add_image_table(gateway, table_parameters, table_data, table_name, image_ids,
+                    raise_errors=True):
+    """Uploads a table once and attaches it to one or more images.
 
     :param gateway: a gateway to the omero server
     :param table_parameters: a list of 2 or 3 element-tuples containing:
@@ -378,16 +1145,13 @@ def add_image_table(gateway, table_parameters, table_data, table_name, image_ids
         3- optional, a string containing the description of the column
     :param table_data: a list of lists containing the data
     :param table_name: a string containing the table name. Must be unique
-    :param image_ids: the id (of list of ids) of the target image(s)
+    :param image_ids: the id (or list of ids) of the target image(s)
+    :param raise_errors: if True a TableAttachmentError is raised when the
+        table cannot be attached to some of the targets. Otherwise a
+        {id: error} dictionary of these targets is returned
     """
-    if not hasattr(image_ids, '__iter__'):
-        image_ids = [image_ids]
-    for image in image_ids:
-        target = ImageI(image, False)
-        try:
-            _add_table(gateway, table_parameters, table_data, table_name, target)
-        except Exception as e:
-            print(e)
+    return _add_table_to_targets(gateway, table_parameters, table_data, table_name,
+                                 image_ids, ImageAnnotationLinkI, ImageI, raise_errors)
 
 
 def _get_available_tables(gateway, target):
@@ -422,4 +1186,705 @@ def get_image_tables_file_names(gateway, image_id):
     return [t.getFileName() for t in tables]
 
 
+def _primitive_array(values, type_code):
+    """Returns values as a primitive java array, without copying jarrays of the right type"""
+    if getattr(values, 'typecode', None) == type_code:
+        return values
+    return array(values, type_code)
+
+
+class TableWriter(object):
+    """Writes a table to OMERO incrementally.
+
+    The table is created once with the schema of table_parameters. Rows are
+    buffered and sent to the server in chunks of chunk_size rows from a
+    background thread. At most max_pending chunks wait to be sent, so the
+    memory used does not depend on the number of rows written.
+    The table is attached to its targets when the writer is closed.
+
+    :param gateway: a gateway to the omero server
+    :param table_parameters: a list of 2 or 3 element-tuples containing:
+        1- a string with column name
+        2- a string with data type. Allowed values are: 'String', 'Long', 'Float', 'Double'
+        3- optional, a string containing the description of the column
+    :param table_name: a string containing the table name
+    :param group_id: the id of the group where the table is created
+    :param chunk_size: the number of rows sent to the server at once
+    :param max_pending: the number of chunks that may wait to be sent
+    :param string_size: the maximum length of the values in String columns
+    """
+
+    _STOP = object()
+
+    def __init__(self, gateway, table_parameters, table_name, group_id, chunk_size=10000,
+                 max_pending=2, string_size=256):
+        self.gateway = gateway
+        self.table_name = table_name
+        self.group_id = group_id
+        self.chunk_size = chunk_size
+        self.string_size = string_size
+        self.rows = 0
+        self.annotation = None
+        self._names = [p[0] for p in table_parameters]
+        self._types = [p[1] if isinstance(p[1], basestring) else p[1].getSimpleName()
+                       for p in table_parameters]
+        self._descriptions = [p[2] if len(p) == 3 else '' for p in table_parameters]
+        self._buffer = []
+        self._error = None
+        self._closed = False
+
+        resources = gateway.getSharedResources(SecurityContext(group_id))
+        repository_id = resources.repositories().descriptions.get(0).getId().getValue()
+        self._table = resources.newTable(repository_id, table_name)
+        if self._table is None:
+            raise Exception('Could not create the table ' + table_name)
+        self._table.initialize(self._columns([[] for _ in self._names]))
+
+        self._queue = Queue.Queue(max_pending)
+        self._worker = threading.Thread(target=self._work, name='omero-table-writer')
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    def _column(self, index, values):
+        name = self._names[index]
+        description = self._descriptions[index]
+        column_type = self._types[index]
+        if column_type == 'String':
+            return StringColumn(name, description, self.string_size,
+                                array([unicode(v) for v in values], String))
+        elif column_type == 'Long':
+            return LongColumn(name, description, _primitive_array(values, 'l'))
+        elif column_type in ('Float', 'Double'):
+            return DoubleColumn(name, description, _primitive_array(values, 'd'))
+        else:
+            raise Exception('Unsupported column type: ' + column_type)
+
+    def _columns(self, columns):
+        return [self._column(i, values) for i, values in enumerate(columns)]
+
+    def _check(self):
+        if self._error is not None:
+            raise Exception('Could not write the table ' + self.table_name + ': ' +
+                            str(self._error))
+
+    def _submit(self, columns, rows):
+        self._check()
+        if self._closed:
+            raise Exception('The table writer is closed')
+        self._queue.put(self._columns(columns))
+        self.rows += rows
+
+    def _submit_buffer(self):
+        if self._buffer:
+            rows = self._buffer
+            self._buffer = []
+            self._submit(zip(*rows), len(rows))
+
+    def add_row(self, row):
+        """Adds a row with a value per column"""
+        if len(row) != len(self._names):
+            raise Exception('The row does not have a value per column')
+        self._buffer.append(row)
+        if len(self._buffer) >= self.chunk_size:
+            self._submit_buffer()
+
+    def add_rows(self, rows):
+        """Adds the rows of a list or of a generator"""
+        for row in rows:
+            self.add_row(row)
+
+    def add_columns(self, columns):
+        """Adds rows given as a list of columns of equal length.
+
+        Numeric columns given as jarray long or double arrays are passed to
+        the server without converting their values.
+        """
+        if len(columns) != len(self._names):
+            raise Exception('Table parameters and data do not have the same length')
+        length = len(columns[0])
+        if any(len(c) != length for c in columns):
+            raise Exception('The columns do not have the same length')
+        self._submit_buffer()
+        for start in range(0, length, self.chunk_size):
+            end = min(start + self.chunk_size, length)
+            self._submit([c[start:end] for c in columns], end - start)
+
+    def _work(self):
+        while True:
+            columns = self._queue.get()
+            try:
+                if columns is self._STOP:
+                    return
+                if self._error is None:
+                    self._table.addData(columns)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Sends the buffered rows and blocks until every chunk is written"""
+        self._submit_buffer()
+        self._queue.join()
+        self._check()
+
+    def close(self, project_ids=None, dataset_ids=None, image_ids=None):
+        """Writes the remaining rows, closes the table and attaches it to the targets.
+
+        Returns the file annotation of the table.
+        """
+        if self._closed:
+            return self.annotation
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._queue.put(self._STOP)
+            self._worker.join()
+            original_file = self._table.getOriginalFile()
+            self._table.close()
+
+        annotation = FileAnnotationI()
+        annotation.setFile(original_file.proxy())
+        annotation.setNs(rtypes.rstring(NSBULKANNOTATIONS.value))
+        self.annotation = self.gateway.getUpdateService(
+            SecurityContext(self.group_id)).saveAndReturnObject(annotation)
+
+        for ids, link_class, parent_class in ((project_ids, ProjectAnnotationLinkI, ProjectI),
+                                              (dataset_ids, DatasetAnnotationLinkI, DatasetI),
+                                              (image_ids, ImageAnnotationLinkI, ImageI)):
+            if ids:
+                _link_existing_annotation(self.gateway, self.annotation, link_class,
+                                          parent_class, ids, self.group_id)
+
+        return self.annotation
+
+
+def results_table_columns(results_table, headings=None):
+    """Returns the table parameters and the columns of an ImageJ ResultsTable.
+
+    Numeric columns are returned as the double arrays held by the table and
+    the row labels, if any, as a String column.
+    :param results_table: an ImageJ ResultsTable
+    :param headings: the headings of the columns to return. Defaults to all of them
+    """
+    if headings is None:
+        headings = list(results_table.getHeadings())
+    table_parameters = []
+    columns = []
+    for heading in headings:
+        if heading == 'Label':
+            table_parameters.append((heading, 'String'))
+            columns.append([results_table.getLabel(i) for i in range(results_table.size())])
+        else:
+            values = results_table.getColumnAsDoubles(results_table.getColumnIndex(heading))
+            if values is None:
+                raise Exception('The results table has no column ' + heading)
+            table_parameters.append((heading, 'Double'))
+            columns.append(values)
+
+    return table_parameters, columns
+
 
+def _add_columns_table(gateway, table_parameters, columns, table_name, **targets):
+    writer = TableWriter(gateway, table_parameters, table_name,
+                         gateway.getLoggedInUser().getGroupId())
+    writer.add_columns(columns)
+
+    return writer.close(**targets)
+
+
+def add_project_table_columns(gateway, table_parameters, columns, table_name, project_ids):
+    """Appends a table given as columns to one or more projects.
+
+    :param columns: a list of columns, as lists or jarray long and double arrays.
+        The other parameters are the same as in add_project_table
+    """
+    return _add_columns_table(gateway, table_parameters, columns, table_name,
+                              project_ids=project_ids)
+
+
+def add_dataset_table_columns(gateway, table_parameters, columns, table_name, dataset_ids):
+    """Appends a table given as columns to one or more datasets.
+
+    :param columns: a list of columns, as lists or jarray long and double arrays.
+        The other parameters are the same as in add_dataset_table
+    """
+    return _add_columns_table(gateway, table_parameters, columns, table_name,
+                              dataset_ids=dataset_ids)
+
+
+def add_image_table_columns(gateway, table_parameters, columns, table_name, image_ids):
+    """Appends a table given as columns to one or more images.
+
+    :param columns: a list of columns, as lists or jarray long and double arrays.
+        The other parameters are the same as in add_image_table
+    """
+    return _add_columns_table(gateway, table_parameters, columns, table_name,
+                              image_ids=image_ids)
+
+
+def _image_in_dataset(gateway, dataset_id, name):
+    """Returns True if the dataset holds an image with this name"""
+    for image in iter_images(gateway, dataset_id, -1, limit=1, name_like=[name]):
+        return True
+    return False
+
+
+class WriteBehindQueue(object):
+    """Writes annotations, tables and uploads to OMERO from a background thread.
+
+    Callers enqueue writes and carry on with their analysis while a worker
+    thread flushes them in batches. The key-value annotations of a batch are
+    saved together, with one request for the annotations and one for their
+    links. Writes are made of steps, such as saving an annotation and then
+    linking it, and a failing step is retried with an exponential backoff
+    without repeating the steps already done. An upload is only retried if
+    the image is not in the dataset yet. Failures are reported when the
+    queue is closed. Pending writes are flushed when the interpreter exits.
+
+    :param session: an OmeroSession. Its gateway is requested for every write
+        so that an expired session is reconnected transparently
+    :param batch_size: the maximum number of writes taken from the queue at once
+    :param retries: the number of times a failing step is retried
+    :param backoff: the delay in seconds before the first retry. It doubles
+        at every attempt
+    """
+
+    _STOP = object()
+
+    def __init__(self, session, batch_size=20, retries=3, backoff=1.0):
+        self.session = session
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.done = 0
+        self.failures = []
+        self._queue = Queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._work, name='omero-write-behind')
+        self._worker.setDaemon(True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def put(self, description, function, *args, **kwargs):
+        """Enqueues function(gateway, *args, **kwargs) as a single step"""
+        self._put({'description': description,
+                   'steps': [lambda gateway, previous: function(gateway, *args, **kwargs)]})
+
+    def _put(self, task):
+        if self._closed:
+            raise Exception('The write-behind queue is closed')
+        self._queue.put(task)
+
+    def add_images_key_values(self, key_values, image_ids, group_id, description=None,
+                              on_success=None):
+        if not hasattr(image_ids, '__iter__'):
+            image_ids = [image_ids]
+        self._put({'description': 'key-values on images ' + str(image_ids),
+                   'on_success': on_success,
+                   'key_values': (_dict_to_map_annotation(key_values, description).asAnnotation(),
+                                  list(image_ids), group_id)})
+
+    def add_images_tag(self, tag_text, image_ids, group_id, description=None):
+        annotation = _tag_annotation(tag_text, description)
+        update = lambda gateway: gateway.getUpdateService(SecurityContext(group_id))
+        self._put({'description': 'tag ' + tag_text + ' on images ' + str(image_ids),
+                   'steps': [lambda gateway, previous:
+                             update(gateway).saveAndReturnObject(annotation),
+                             lambda gateway, tag:
+                             _link_existing_annotation(gateway, tag, ImageAnnotationLinkI,
+                                                       ImageI, image_ids, group_id)]})
+
+    def add_image_table(self, table_parameters, table_data, table_name, image_ids):
+        if not hasattr(image_ids, '__iter__'):
+            image_ids = [image_ids]
+        image_ids = list(image_ids)
+
+        def link(gateway, table):
+            if len(image_ids) > 1:
+                group_id = gateway.getLoggedInUser().getGroupId()
+                annotation = _get_table_annotation(gateway, group_id, table.getOriginalFileId())
+                _link_existing_annotation(gateway, annotation, ImageAnnotationLinkI, ImageI,
+                                          image_ids[1:], group_id)
+
+        self._put({'description': 'table ' + table_name + ' on images ' + str(image_ids),
+                   'steps': [lambda gateway, previous:
+                             _add_table(gateway, table_parameters, table_data, table_name,
+                                        ImageI(image_ids[0], False)),
+                             link]})
+
+    def add_image_table_columns(self, table_parameters, columns, table_name, image_ids):
+        self.put('table ' + table_name + ' on images ' + str(image_ids), add_image_table_columns,
+                 table_parameters, columns, table_name, image_ids)
+
+    def _upload_steps(self, path, host, dataset_id):
+        attempts = []
+
+        def upload(gateway, previous):
+            # An upload that failed may still have created the image
+            if attempts and _image_in_dataset(gateway, dataset_id, os.path.basename(path)):
+                return True
+            attempts.append(path)
+            return upload_image(gateway, path, host, dataset_id)
+
+        return [upload]
+
+    def upload_image(self, path, host, dataset_id):
+        self._put({'description': 'upload of ' + path,
+                   'steps': self._upload_steps(path, host, dataset_id)})
+
+    def upload_image_plus(self, imp, host, dataset_id, compression='LZW', temp_dir=None,
+                          name=None, on_success=None):
+        """Exports the image now and uploads it in the background.
+
+        The exported file is removed once the upload succeeds. It is kept if
+        the upload fails so that it can be recovered.
+        on_success is called from the worker thread once the image is uploaded.
+        """
+        path = export_image_plus(imp, compression, temp_dir, name)
+        steps = self._upload_steps(path, host, dataset_id)
+        steps.append(lambda gateway, previous: _remove_export(path))
+        self._put({'description': 'upload of ' + path,
+                   'on_success': on_success,
+                   'steps': steps})
+
+    def _run_step(self, description, step, previous):
+        """Runs a step, retrying it alone. Returns (success, result)"""
+        for attempt in range(self.retries + 1):
+            try:
+                result = step(self.session.get_gateway(), previous)
+                if result is False:
+                    raise Exception('Write returned an unsuccessful status')
+                return True, result
+            except Exception as e:
+                if attempt == self.retries:
+                    print('Failed ' + description + ': ' + str(e))
+                    return False, str(e)
+                time.sleep(self.backoff * pow(2, attempt))
+
+    def _run(self, tasks, description, steps):
+        """Runs the steps of one or more merged tasks and reports each task"""
+        result = None
+        for step in steps:
+            success, result = self._run_step(description, step, result)
+            if not success:
+                for task in tasks:
+                    self.failures.append((task['description'], result))
+                return
+        for task in tasks:
+            self.done += 1
+            if task.get('on_success') is not None:
+                try:
+                    task['on_success']()
+                except Exception as e:
+                    print('Callback of ' + task['description'] + ' failed: ' + str(e))
+
+    def _run_key_values(self, tasks):
+        """Saves the key-value annotations of several tasks in one request and their links in another"""
+        by_group = {}
+        for task in tasks:
+            by_group.setdefault(task['key_values'][2], []).append(task)
+        for group_id, group_tasks in by_group.items():
+            update = lambda gateway, group_id=group_id: \
+                gateway.getUpdateService(SecurityContext(group_id))
+
+            def save_links(gateway, annotations, group_tasks=group_tasks, update=update):
+                links = []
+                for annotation, task in zip(annotations, group_tasks):
+                    for image_id in task['key_values'][1]:
+                        link = ImageAnnotationLinkI()
+                        link.setChild(annotation.proxy())
+                        link.setParent(ImageI(image_id, False))
+                        links.append(link)
+                return update(gateway).saveAndReturnArray(links)
+
+            steps = [lambda gateway, previous, group_tasks=group_tasks, update=update:
+                     update(gateway).saveAndReturnArray([task['key_values'][0]
+                                                         for task in group_tasks]),
+                     save_links]
+            description = ('key-values on images ' +
+                           str([task['key_values'][1] for task in group_tasks]))
+            self._run(group_tasks, description, steps)
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            tasks = [task for task in batch if task is not self._STOP]
+            key_values = [task for task in tasks if 'key_values' in task]
+            if key_values:
+                self._run_key_values(key_values)
+            for task in tasks:
+                if 'key_values' not in task:
+                    self._run([task], task['description'], task['steps'])
+            for task in batch:
+                self._queue.task_done()
+            if self._STOP in batch:
+                return
+
+    def flush(self):
+        """Blocks until every enqueued write has been processed"""
+        self._queue.join()
+
+    def close(self):
+        """Flushes the pending writes, stops the worker and returns a report"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(self._STOP)
+            self._worker.join()
+
+        return self.report()
+
+    def report(self):
+        return {'done': self.done,
+                'pending': self._queue.qsize(),
+                'failures': list(self.failures)}
+
+
+class ResultCache(object):
+    """On-disk cache of analysis results.
+
+    Entries are keyed by image id, pixels fingerprint (see
+    get_image_fingerprint), analysis name and analysis parameters. They hold
+    the measurements and the derived images of the analysis, saved as
+    zip-compressed TIFFs. When the cache grows over max_size bytes the least
+    recently used entries are evicted. The index is saved when entries are
+    added and when the cache is closed.
+    """
+
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, 'index.json')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._entries = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as index_file:
+                self._entries = json.load(index_file)
+        atexit.register(self.close)
+
+    @staticmethod
+    def _key(image_id, fingerprint, analysis, parameters):
+        return hashlib.sha1(repr((long(image_id), fingerprint, analysis, parameters))).hexdigest()
+
+    def get(self, image_id, fingerprint, analysis, parameters=''):
+        """Returns (images, measurements) or None if the result is not cached"""
+        key = self._key(image_id, fingerprint, analysis, parameters)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Read the files under the lock so that they cannot be evicted meanwhile
+                images = []
+                for title, file_name in entry['images']:
+                    imp = IJ.openImage(os.path.join(self.directory, file_name))
+                    if imp is None:
+                        break
+                    imp.setTitle(title)
+                    images.append(imp)
+                else:
+                    entry['last_used'] = time.time()
+                    self.hits += 1
+                    return images, entry['measurements']
+                # Files removed behind the cache's back
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def contains(self, image_id, fingerprint, analysis, parameters=''):
+        with self._lock:
+            return self._key(image_id, fingerprint, analysis, parameters) in self._entries
+
+    def put(self, image_id, fingerprint, analysis, parameters, images, measurements):
+        key = self._key(image_id, fingerprint, analysis, parameters)
+        entry = {'images': [], 'measurements': measurements, 'size': 0,
+                 'last_used': time.time()}
+        for i in range(len(images)):
+            file_name = key + '_' + str(i) + '.zip'
+            path = os.path.join(self.directory, file_name)
+            FileSaver(images[i]).saveAsZip(path)
+            entry['images'].append((images[i].getTitle(), file_name))
+            entry['size'] += os.path.getsize(path)
+        with self._lock:
+            self._entries[key] = entry
+            self._evict()
+            self._save_index()
+
+    def _remove(self, key):
+        for title, file_name in self._entries.pop(key)['images']:
+            path = os.path.join(self.directory, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _evict(self):
+        size = sum(entry['size'] for entry in self._entries.values())
+        by_use = sorted(self._entries.items(), key=lambda item: item[1]['last_used'])
+        while size > self.max_size and by_use:
+            key, entry = by_use.pop(0)
+            self._remove(key)
+            size -= entry['size']
+
+    def _save_index(self):
+        with open(self._index_path, 'w') as index_file:
+            json.dump(self._entries, index_file)
+
+    def close(self):
+        """Saves the index, with the last use of the entries read since the last save"""
+        with self._lock:
+            self._save_index()
+
+    def report(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries)}
+
+
+class Prefetcher(object):
+    """Loads the images of the next items on a background thread while the
+    current ones are being processed.
+
+    :param items: the items, in the order they will be processed
+    :param load: a function returning a {name: ImagePlus} dictionary for an item.
+        If it fails the error is printed and the item comes with an empty dictionary
+    :param depth: the maximum number of loaded items waiting to be processed
+    :param memory_budget: optional, the maximum number of bytes held by loaded
+        items waiting or being processed. Once exceeded, the loader blocks
+        until items are released or, if spill_dir is given, saves the images
+        of the item to disk until they are requested.
+    :param spill_dir: optional, the directory where images are spilled
+    :param estimate: optional, a function returning the number of bytes the
+        images of an item will take, such as get_image_memory_size. The
+        estimate is reserved from the memory budget before the item is loaded
+        and the loader blocks until it fits, so the budget is never exceeded
+        by a download. Images are only spilled when no estimate is given, as
+        they must then be loaded to be measured.
+
+    Items are taken with next(), or by iterating, and must be released once
+    processed. Iterating releases the previous item automatically.
+    """
+
+    _END = object()
+
+    def __init__(self, items, load, depth=1, memory_budget=None, spill_dir=None, estimate=None):
+        self.load = load
+        self.estimate = estimate
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.spilled = 0
+        self._items = list(items)
+        self._queue = Queue.Queue(max(depth, 1))
+        self._memory = 0
+        self._sizes = {}
+        self._condition = threading.Condition()
+        self._loader = threading.Thread(target=self._work, name='omero-prefetch')
+        self._loader.setDaemon(True)
+        self._loader.start()
+
+    @staticmethod
+    def _size(images):
+        return sum([imp.getSizeInBytes() for imp in images.values() if imp is not None])
+
+    def _reserve(self, item):
+        """Blocks until the estimated size of an item fits in the budget and reserves it"""
+        try:
+            reserved = self.estimate(item)
+        except Exception as e:
+            print('Estimating the size of ' + str(item) + ' failed: ' + str(e))
+            reserved = 0
+        with self._condition:
+            while self._memory > 0 and self._memory + reserved > self.memory_budget:
+                self._condition.wait()
+            self._memory += reserved
+        return reserved
+
+    def _work(self):
+        for item in self._items:
+            reserved = None
+            if self.memory_budget and self.estimate is not None:
+                reserved = self._reserve(item)
+            try:
+                images = self.load(item)
+            except Exception as e:
+                print('Prefetching ' + str(item) + ' failed: ' + str(e))
+                images = {}
+            size = self._size(images)
+            with self._condition:
+                if reserved is not None:
+                    # Replace the estimate by the actual size
+                    self._memory -= reserved
+                elif self.memory_budget and self.spill_dir:
+                    if self._memory > 0 and self._memory + size > self.memory_budget:
+                        images = self._spill(images)
+                        size = 0
+                elif self.memory_budget:
+                    while self._memory > 0 and self._memory + size > self.memory_budget:
+                        self._condition.wait()
+                self._memory += size
+                self._condition.notifyAll()
+            self._queue.put((item, images, size))
+        self._queue.put(self._END)
+
+    def _spill(self, images):
+        spilled = {}
+        for name, imp in images.items():
+            if imp is None:
+                spilled[name] = None
+                continue
+            path = os.path.join(tempfile.mkdtemp(dir=self.spill_dir), 'spilled.tif')
+            FileSaver(imp).saveAsTiff(path)
+            spilled[name] = (path, imp.getTitle())
+            imp.flush()
+        self.spilled += 1
+        return spilled
+
+    def _restore(self, images):
+        restored = {}
+        for name, image in images.items():
+            if isinstance(image, tuple):
+                path, title = image
+                image = IJ.openImage(path)
+                image.setTitle(title)
+                shutil.rmtree(os.path.dirname(path), True)
+            restored[name] = image
+        return restored
+
+    def next(self):
+        """Returns the next (item, images) tuple. Raises StopIteration at the end"""
+        entry = self._queue.get()
+        if entry is self._END:
+            # Let any other consumer stop as well
+            self._queue.put(self._END)
+            raise StopIteration
+        item, images, size = entry
+        images = self._restore(images)
+        with self._condition:
+            if size == 0:
+                size = self._size(images)
+                self._memory += size
+            self._sizes[id(images)] = size
+        return item, images
+
+    def release(self, images):
+        """Frees the memory budget held by the images of a processed item"""
+        with self._condition:
+            self._memory -= self._sizes.pop(id(images), 0)
+            self._condition.notifyAll()
+
+    def __iter__(self):
+        images = None
+        while True:
+            if images is not None:
+                self.release(images)
+            try:
+                item, images = self.next()
+            except StopIteration:
+                return
+            yield item, images
@@ -24,97 +24,43 @@ from omero.log import Logger
 from omero.log import SimpleLogger
 from omero.model import Pixels
 
-from ome.formats.importer import ImportConfig
-from ome.formats.importer import OMEROWrapper
-from ome.formats.importer import ImportLibrary
-from ome.formats.importer import ImportCandidates
-from ome.formats.importer.cli import ErrorHandler
-from ome.formats.importer.cli import LoggingImportMonitor
-import loci.common
-from loci.formats.in import DefaultMetadataOptions
-from loci.formats.in import MetadataLevel
 from ij import IJ
 
-def openImagePlus(HOST,USERNAME,PASSWORD,groupId,imageId):
-    
-    options = ""
-        options += "location=[OMERO] open=[omero:server="
-        options += HOST
-        options += "\nuser="
-        options += USERNAME
-        options += "\npass="
-        options += PASSWORD
-        options += "\ngroupID="
-        options += groupId
-        options += "\niid="
-        options += imageId
-        options += "]"
-        options += " windowless=true "
-        
-        IJ.runPlugIn("loci.plugins.LociImporter", options);
+from OMERO_toolbox import upload_image_plus
+from OMERO_toolbox import close_importers
+from OMERO_toolbox import get_image_plus
+from OMERO_toolbox import Prefetcher
+from OMERO_toolbox import get_image_memory_size
 
 def omeroConnect():
-    
+
     # Omero Connect with credentials and simpleLogger
     cred = LoginCredentials()
-        cred.getServer().setHostname(HOST)
-        cred.getServer().setPort(PORT)
-        cred.getUser().setUsername(USERNAME.strip())
-        cred.getUser().setPassword(PASSWORD.strip())
-        simpleLogger = SimpleLogger()
-        gateway = Gateway(simpleLogger)
-        gateway.connect(cred)
-        return gateway
+    cred.getServer().setHostname(HOST)
+    cred.getServer().setPort(PORT)
+    cred.getUser().setUsername(USERNAME.strip())
+    cred.getUser().setPassword(PASSWORD.strip())
+    simpleLogger = SimpleLogger()
+    gateway = Gateway(simpleLogger)
+    gateway.connect(cred)
+    return gateway
 
 # List all ImageId's under a Project/Dataset
 def getImageIds(gateway, datasetId):
-    
+
     browse = gateway.getFacility(BrowseFacility)
-        user = gateway.getLoggedInUser()
-        ctx = SecurityContext(user.getGroupId())
-        ids = ArrayList(1)
-        val = Long(datasetId)
-        ids.add(val)
-        images = browse.getImagesForDatasets(ctx, ids)
-        j = images.iterator()
-        imageIds = []
-        while j.hasNext():
-            image = j.next()
-                imageIds.append(String.valueOf(image.getId()))
-        return imageIds
-
-
-def uploadImage(path, gateway):
-    
     user = gateway.getLoggedInUser()
-        ctx = SecurityContext(user.getGroupId())
-        sessionKey = gateway.getSessionId(user)
-        
-        config = ImportConfig()
-        
-        config.email.set("")
-        config.sendFiles.set('true')
-        config.sendReport.set('false')
-        config.contOnError.set('false')
-        config.debug.set('false')
-        config.hostname.set(HOST)
-        config.sessionKey.set(sessionKey)
-        config.targetClass.set("omero.model.Dataset")
-        config.targetId.set(datasetId)
-        
-        loci.common.DebugTools.enableLogging("DEBUG")
-        
-        store = config.createStore()
-        reader = OMEROWrapper(config)
-        
-        library = ImportLibrary(store,reader)
-        errorHandler = ErrorHandler(config)
-        
-        library.addObserver(LoggingImportMonitor())
-        candidates = ImportCandidates (reader, path, errorHandler)
-        reader.setMetadataOptions(DefaultMetadataOptions(MetadataLevel.ALL))
-        success = library.importCandidates(config, candidates)
-        return success
+    ctx = SecurityContext(user.getGroupId())
+    ids = ArrayList(1)
+    val = Long(datasetId)
+    ids.add(val)
+    images = browse.getImagesForDatasets(ctx, ids)
+    j = images.iterator()
+    imageIds = []
+    while j.hasNext():
+        image = j.next()
+        imageIds.append(String.valueOf(image.getId()))
+    return imageIds
 
 # Setup
 # =====
@@ -158,31 +104,34 @@ gateway = omeroConnect()
 imageIds = getImageIds(gateway,datasetId);
 imageIds.sort()
 
-for imageId in imageIds:
+# The next image is downloaded while the current one is analysed
+prefetcher = Prefetcher(imageIds,
+                        lambda imageId: {'image': get_image_plus(gateway, long(imageId), long(groupId))},
+                        depth=1, memory_budget=2048 * 1024 * 1024,
+                        estimate=lambda imageId: get_image_memory_size(gateway, long(imageId), long(groupId)))
+
+for imageId, images in prefetcher:
     #	imageId = imageIds[2]
-    print imageId
-        openImagePlus(HOST,USERNAME,PASSWORD,groupId,imageId)
-        IJ.run("Enhance Contrast", "saturated=0.35");
-        #Plug Your analysis here#
-        
-        IJ.runMacroFile(macroFilePath)
-        
-        #	Save resultant image using Bio-Formats
-        imp = IJ.getImage();
-        path = paths + imp.getTitle() + operation + ".ome.tiff";
-        print(path)
-        options = "save=" + path + " export compression=Uncompressed"
-        IJ.run(imp, "Bio-Formats Exporter", options);
-        imp.changes = False
-        imp.close()
-        
-        #	Upload image to OMERO
-        str2d = java.lang.reflect.Array.newInstance(java.lang.String,[1])
-        str2d [0] = path
-        success = uploadImage(str2d, gateway)
+    print(imageId)
+    if 'image' not in images:
+        print("Skipping image " + str(imageId) + ", it could not be loaded")
+        continue
+    images['image'].show()
+    IJ.run("Enhance Contrast", "saturated=0.35");
+    #Plug Your analysis here#
+
+    IJ.runMacroFile(macroFilePath)
+
+    #	Upload resultant image to OMERO through a single compressed temporary file
+    imp = IJ.getImage();
+    name = imp.getTitle() + operation + ".ome.tiff"
+    print(name)
+    success = upload_image_plus(gateway, imp, HOST, datasetId, "LZW", paths, name)
+    imp.changes = False
+    imp.close()
 
 print("Done")
-#success = uploadImage(str2d, gateway)
+close_importers()
 gateway.disconnect()	
 
 
@@ -0,0 +1,99 @@
+'''
+Summary statistics over the columns of measurement tables.
+
+The values are held in primitive double arrays, as returned by
+ResultsTable.getColumnAsDoubles, and are processed on the Java side. Every
+statistic is computed once per column.
+'''
+
+from java.util import Arrays
+from java.util.stream import DoubleStream
+from org.apache.commons.math3.stat import StatUtils
+from jarray import array
+
+from math import sqrt
+
+
+def _as_doubles(values):
+    if getattr(values, 'typecode', None) == 'd':
+        return values
+    return array(values, 'd')
+
+
+class ColumnStatistics(object):
+    """Statistics of a column of values.
+
+    The count, mean, minimum and maximum are computed in a single pass by a
+    DoubleStream, and the standard deviation by commons-math. A sorted copy is
+    made the first time the median or a percentile is requested and is reused
+    afterwards.
+
+    :param values: a double array, or any sequence of numbers
+    """
+
+    def __init__(self, values):
+        self.values = _as_doubles(values)
+        self._sorted = None
+        self._summary = None
+        self._variances = {}
+
+    def _summarize(self):
+        if self._summary is None:
+            if not len(self.values):
+                raise ValueError('No values to summarize')
+            self._summary = DoubleStream.of(self.values).summaryStatistics()
+        return self._summary
+
+    def count(self):
+        return len(self.values)
+
+    def mean(self):
+        return self._summarize().getAverage()
+
+    def min(self):
+        return self._summarize().getMin()
+
+    def max(self):
+        return self._summarize().getMax()
+
+    def std_dev(self, center=None):
+        """Returns the sample standard deviation.
+
+        :param center: the value the deviations are measured from. Defaults to the mean
+        """
+        if len(self.values) < 2:
+            raise ValueError('At least two values are needed for a standard deviation')
+        if center is None:
+            center = self.mean()
+        if center not in self._variances:
+            self._variances[center] = StatUtils.variance(self.values, center)
+        return sqrt(self._variances[center])
+
+    def sorted_values(self):
+        if self._sorted is None:
+            self._sorted = Arrays.copyOf(self.values, len(self.values))
+            Arrays.sort(self._sorted)
+        return self._sorted
+
+    def percentile(self, percent):
+        """Returns the percentile, interpolating linearly between the closest ranks"""
+        values = self.sorted_values()
+        if not len(values):
+            raise ValueError('No values to summarize')
+        position = (len(values) - 1) * percent / 100.0
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    def median(self):
+        return self.percentile(50)
+
+    def summary(self):
+        """Returns a dictionary with the count, mean, median, standard deviation, min and max"""
+        return {'count': self.count(),
+                'mean': self.mean(),
+                'median': self.median(),
+                'std_dev': self.std_dev() if self.count() > 1 else float('nan'),
+                'min': self.min(),
+                'max': self.max()}
+